@@ -1,18 +1,145 @@
-import os, requests
+import os, time, random, threading, queue, fcntl, requests
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor, Future
 from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
+from requests.adapters import HTTPAdapter
+import metrics
 from report_core import (
     build_report, build_section_nuovo, build_section_km0, build_section_usato,
     fetch_all_items, filter_by_brand, filter_by_type, filter_by_dealer, filter_by_caps,
     format_cards, get_funds_estimate, should_alert_low_funds, detect_new_deals,
-    detect_flash_deals, load_user, save_user
+    detect_flash_deals, load_user, update_user, build_storico, snapshot_events, format_price_drops,
+    mark_seen, refresh_seen, get_snapshot, ALL_SOURCES, DATA_DIR, get_index, match_subscriptions
 )
 
 BOT_TOKEN = os.getenv("TG_BOT_TOKEN", "")
 ALLOWED_CHAT_ID = int(os.getenv("TG_CHAT_ID", "0") or "0")
 RUN_SECRET = os.getenv("RUN_SECRET", "")
-API = f"https://api.telegram.org/bot{BOT_TOKEN}"
+TG_API_BASE = os.getenv("TG_API_BASE", "https://api.telegram.org").rstrip("/")  # es. stub locale nei test
+API = f"{TG_API_BASE}/bot{BOT_TOKEN}"
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "25"))   # messaggi/s in totale (limite Telegram ~30)
+TG_CHAT_RATE   = float(os.getenv("TG_CHAT_RATE", "1"))      # messaggi/s per chat
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "5"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))  # comandi eseguiti in parallelo dal webhook
+SCHEDULER      = os.getenv("SCHEDULER", "1") == "1"         # polling interno al posto del cron esterno
+SCHED_MIN      = float(os.getenv("SCHED_MIN", "300"))       # intervallo minimo per fonte (s)
+SCHED_MAX      = float(os.getenv("SCHED_MAX", "3600"))      # intervallo massimo per fonte (s)
+SCHED_START    = float(os.getenv("SCHED_START", "900"))     # intervallo iniziale
+SCHED_FUNDS    = float(os.getenv("SCHED_FUNDS", "3600"))    # controllo fondi Ecobonus (s)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    if SCHEDULER:
+        start_scheduler()
+    yield
+
+app = FastAPI(lifespan=lifespan)
+
+@app.middleware("http")
+async def timing(request: Request, call_next):
+    # tempo per endpoint; con DEBUG_TIMINGS=1 anche il dettaglio per fase (header Server-Timing + log)
+    before = metrics.sums() if metrics.DEBUG_TIMINGS else None
+    t0 = time.perf_counter()
+    response = await call_next(request)
+    # etichetta = template della route (valori limitati); URL senza route (scanner, 404) tutti in "other"
+    route = request.scope.get("route")
+    metrics.observe("http_request_seconds", time.perf_counter() - t0, path=getattr(route, "path", "other"))
+    if before is not None:
+        parts = metrics.breakdown(before)
+        print(f"[timing] {request.method} {request.url.path}:", parts)
+        response.headers["Server-Timing"] = ", ".join(
+            f'm{i};dur={v * 1000:.1f};desc="{k.replace(chr(34), chr(39))}"' for i, (k, v) in enumerate(list(parts.items())[:20]))
+    return response
+
+# ===== Invio Telegram: coda + worker =====
+# send_message/send_photo accodano e tornano subito; un solo worker invia in ordine FIFO
+# (i pezzi di un messaggio lungo restano in ordine) rispettando i limiti di Telegram,
+# i 429 con retry_after e un backoff esponenziale sugli errori.
+_OUTBOX = queue.Queue()
+_OUT_LOCK = threading.Lock()
+_OUT_WORKER = None
+_TG = requests.Session()
+_TG.mount("https://", HTTPAdapter(pool_maxsize=4))
+_TG.mount("http://", HTTPAdapter(pool_maxsize=4))
+_next_global = 0.0
+_next_chat = {}   # chat_id -> prossimo invio consentito (monotonic)
+
+def _enqueue(method, data):
+    global _OUT_WORKER
+    with _OUT_LOCK:
+        if _OUT_WORKER is None or not _OUT_WORKER.is_alive():
+            _OUT_WORKER = threading.Thread(target=_outbox_loop, daemon=True, name="tg-outbox")
+            _OUT_WORKER.start()
+    _OUTBOX.put((method, data))
+
+def _wait_slot(chat_id):
+    global _next_global
+    now = time.monotonic()
+    wait = max(_next_global, _next_chat.get(chat_id, 0.0)) - now
+    if wait > 0:
+        time.sleep(wait)
+        now = time.monotonic()
+    _next_global = now + 1.0 / TG_GLOBAL_RATE
+    _next_chat[chat_id] = now + 1.0 / TG_CHAT_RATE
+
+def _post(method, data):
+    """Un invio con retry; ritorna True se Telegram ha accettato"""
+    for attempt in range(TG_MAX_RETRIES):
+        _wait_slot(data.get("chat_id"))
+        if attempt:
+            metrics.inc("tg_retries_total", method=method)
+        t0 = time.perf_counter()
+        try:
+            r = _TG.post(f"{API}/{method}", data=data, timeout=20)
+            body = r.json() if r.headers.get("content-type", "").startswith("application/json") else {}
+        except Exception as e:
+            metrics.inc("tg_errors_total", method=method, error=type(e).__name__)
+            print(f"TG {method} error:", e)
+            time.sleep(min(2 ** attempt, 30))
+            continue
+        finally:
+            metrics.observe("tg_send_seconds", time.perf_counter() - t0, method=method)
+        if r.status_code == 200:
+            metrics.inc("tg_messages_total", method=method, result="ok")
+            return True
+        if r.status_code == 429:
+            retry = (body.get("parameters") or {}).get("retry_after", 1)
+            _next_chat[data.get("chat_id")] = time.monotonic() + retry
+            metrics.inc("tg_429_total", method=method)
+            print(f"TG {method} 429, retry_after={retry}")
+            continue
+        if r.status_code == 400 and data.get("parse_mode"):
+            # Markdown non valido (es. titoli con * o _): riprova come testo semplice
+            data = {k: v for k, v in data.items() if k != "parse_mode"}
+            continue
+        if r.status_code >= 500:
+            time.sleep(min(2 ** attempt, 30))
+            continue
+        print(f"TG {method} failed:", r.status_code, body.get("description", r.text[:200]))
+        metrics.inc("tg_messages_total", method=method, result="failed")
+        return False
+    print(f"TG {method} dropped after {TG_MAX_RETRIES} attempts")
+    metrics.inc("tg_messages_total", method=method, result="dropped")
+    return False
+
+def _outbox_loop():
+    while True:
+        method, data = _OUTBOX.get()
+        try:
+            _post(method, data)
+        except Exception as e:
+            print("TG outbox error:", e)
+        finally:
+            _OUTBOX.task_done()
+
+def flush_outbox(timeout=None):
+    """Attende che la coda di invio sia vuota (test/benchmark); False se scade il timeout"""
+    t = threading.Thread(target=_OUTBOX.join, daemon=True)
+    t.start()
+    t.join(timeout)
+    return not t.is_alive()
 
 def send_message(chat_id: int, text: str, parse_mode: str = None):
     if not BOT_TOKEN or not chat_id:
@@ -21,22 +148,22 @@ def send_message(chat_id: int, text: str, parse_mode: str = None):
     for chunk in [text[i:i+3800] for i in range(0, len(text), 3800)] or ["(vuoto)"]:
         data = {"chat_id": chat_id, "text": chunk, "disable_web_page_preview": "true"}
         if parse_mode: data["parse_mode"] = parse_mode
-        try:
-            requests.post(f"{API}/sendMessage", data=data, timeout=20)
-        except Exception as e:
-            print("Send error:", e)
+        _enqueue("sendMessage", data)
 
 def send_photo(chat_id: int, photo_url: str, caption: str = ""):
     if not BOT_TOKEN or not chat_id or not photo_url: return
-    try:
-        requests.post(f"{API}/sendPhoto", data={"chat_id": chat_id, "photo": photo_url, "caption": caption}, timeout=20)
-    except Exception as e:
-        print("Photo error:", e)
+    _enqueue("sendPhoto", {"chat_id": chat_id, "photo": photo_url, "caption": caption})
 
 @app.get("/health")
 def health():
     return {"ok": True, "has_token": bool(BOT_TOKEN), "has_chat": bool(ALLOWED_CHAT_ID)}
 
+@app.get("/metrics")
+def metrics_endpoint():
+    """Metriche in formato Prometheus (fetch, parsing, scritture, invii Telegram, endpoint)"""
+    metrics.gauge("tg_outbox_size", _OUTBOX.qsize())
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 # ===== Manual run (for cron/GET) =====
 @app.get("/run")
 def run(key: str = ""):
@@ -46,19 +173,25 @@ def run(key: str = ""):
     return {"ok": True}
 
 # ===== Periodic tick (alerts proattive) =====
-@app.get("/tick")
-def tick(key: str = ""):
-    if not RUN_SECRET or key != RUN_SECRET:
-        return {"ok": False, "error": "unauthorized"}
-    # 1) fondi bassi
+def check_funds():
     low = should_alert_low_funds(th=15)
     if low:
-        below = ", ".join([f"{k.upper()} {v}%" for k,v in low["below"].items()])
-        send_message(ALLOWED_CHAT_ID, f"⚠️ Fondi bassi: {below}. Consiglio: prenota subito.", None)
+        parts = []
+        for k, v in low["below"].items():
+            days = low["forecast"].get(k)
+            parts.append(f"{k.upper()} al {v}%" + (f", esaurimento previsto tra ~{max(1, round(days))} giorni" if days is not None else ""))
+        send_message(ALLOWED_CHAT_ID, f"⚠️ Fondi Ecobonus: {'; '.join(parts)}. Consiglio: prenota subito.", None)
+
+def process_sources(keys, full=False):
+    """Riscarica le fonti e manda gli alert solo per le variazioni rispetto al giro precedente"""
+    by_source = get_snapshot(keys, force=True, full=full)
+    events = snapshot_events(by_source)  # scrive anche lo storico delle variazioni
+    changed = list({e["id"]: e["item"] for e in events if e["item"]}.values())
+    mark_seen([e["id"] for e in events if e["type"] == "removed"])
 
-    # 2) nuove promo
-    items = fetch_all_items()
-    fresh = detect_new_deals(items)
+    # nuove promo
+    fresh = detect_new_deals([e["item"] for e in events if e["type"] == "added"])
+    refresh_seen(by_source)  # dopo detect_new_deals: le nuove non devono risultare già viste
     if fresh:
         msg = "🆕 Nuove promo rilevate:\n\n" + format_cards(fresh[:5], with_images=False)
         send_message(ALLOWED_CHAT_ID, msg, parse_mode="Markdown")
@@ -67,17 +200,168 @@ def tick(key: str = ""):
             if it.get("image"):
                 send_photo(ALLOWED_CHAT_ID, it["image"], caption=it["title"])
 
-    # 3) occasioni lampo
-    hot = detect_flash_deals(items, km_cap=15000, price_cap=18000)
+    # ribassi
+    drops = format_price_drops(events)
+    if drops:
+        send_message(ALLOWED_CHAT_ID, "📉 Prezzi in calo:\n\n" + drops)
+
+    # occasioni lampo (tra le auto nuove o cambiate)
+    hot = detect_flash_deals(changed, km_cap=15000, price_cap=18000)
     if hot:
         msg = "🔥 Occasioni lampo (<=15.000 km e <=18.000 €):\n\n" + format_cards(hot[:5], with_images=False)
         send_message(ALLOWED_CHAT_ID, msg, parse_mode="Markdown")
-    return {"ok": True}
+
+    # preferenze /config: un messaggio per chat con tutte le auto che rispettano le sue regole
+    for chat_id, its in match_subscriptions(changed).items():
+        msg = f"🎯 {len(its)} auto per le tue preferenze:\n\n" + format_cards(its[:10], with_images=False)
+        send_message(chat_id, msg, parse_mode="Markdown")
+    return events
+
+@app.get("/tick")
+def tick(key: str = "", full: bool = False):
+    if not RUN_SECRET or key != RUN_SECRET:
+        return {"ok": False, "error": "unauthorized"}
+    # 1) fondi bassi
+    check_funds()
+    # 2) tutte le fonti (full=1: crawl completo di tutte le pagine)
+    locks = [_SCHED[k]["lock"] for k in ALL_SOURCES]
+    for l in locks: l.acquire()
+    try:
+        events = process_sources(ALL_SOURCES, full=full)
+    finally:
+        for l in locks: l.release()
+    return {"ok": True, "events": len(events)}
+
+# ===== Scheduler interno =====
+# Ogni fonte ha il suo intervallo: si dimezza quando il giro trova variazioni, cresce del 50%
+# quando non trova niente (tra SCHED_MIN e SCHED_MAX), con ±10% di jitter. Un lock per fonte
+# evita giri sovrapposti (anche con /tick), un file lock evita più scheduler con più worker.
+_SCHED = {k: {"interval": SCHED_START, "last_run": None, "next_run": None, "last_events": None,
+              "last_change": None, "runs": 0, "lock": threading.Lock()} for k in ALL_SOURCES + ["ecobonus_fondi"]}
+_SCHED["ecobonus_fondi"]["interval"] = SCHED_FUNDS
+_SCHED_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="sched")
+_SCHED_LOCKFILE = None
+
+def _jitter(sec):
+    return sec * random.uniform(0.9, 1.1)
+
+def _run_job(key):
+    st = _SCHED[key]
+    if not st["lock"].acquire(blocking=False):
+        st["next_run"] = time.time() + 30  # giro precedente (o /tick) ancora in corso: si riprova dopo
+        return
+    try:
+        if key == "ecobonus_fondi":
+            check_funds()
+        else:
+            n = len(process_sources([key]))
+            st["last_events"] = n
+            if n:
+                st["last_change"] = time.time()
+                st["interval"] = max(SCHED_MIN, st["interval"] / 2)
+            else:
+                st["interval"] = min(SCHED_MAX, st["interval"] * 1.5)
+    except Exception as e:
+        print("Scheduler error:", key, e)
+    finally:
+        st["runs"] += 1
+        st["last_run"] = time.time()
+        st["next_run"] = st["last_run"] + _jitter(st["interval"])
+        st["lock"].release()
+
+def _scheduler_loop():
+    now = time.time()
+    for i, st in enumerate(_SCHED.values()):
+        st["next_run"] = now + 5 * i  # partenze scaglionate
+    while True:
+        now = time.time()
+        for key, st in _SCHED.items():
+            if st["next_run"] is not None and st["next_run"] <= now and not st["lock"].locked():
+                st["next_run"] = None  # in corso
+                _SCHED_POOL.submit(_run_job, key)
+        time.sleep(1)
+
+def start_scheduler():
+    global _SCHED_LOCKFILE
+    f = open(os.path.join(DATA_DIR, "scheduler.lock"), "w")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        print("Scheduler già attivo in un altro worker.")
+        return False
+    _SCHED_LOCKFILE = f
+    threading.Thread(target=_scheduler_loop, daemon=True, name="scheduler").start()
+    return True
+
+@app.get("/schedule")
+def schedule():
+    now = time.time()
+    return {"ok": True, "running": _SCHED_LOCKFILE is not None, "sources": {
+        k: {"interval_s": round(st["interval"]), "runs": st["runs"], "busy": st["lock"].locked(),
+            "last_run": st["last_run"], "next_run": st["next_run"],
+            "next_in_s": None if st["next_run"] is None else round(st["next_run"] - now),
+            "last_events": st["last_events"], "last_change": st["last_change"]}
+        for k, st in _SCHED.items()}}
 
 # ===== Webhook Telegram =====
+# Il webhook risponde subito e passa il comando al pool; gli update_id già ricevuti
+# (reinvii di Telegram) vengono scartati, e richieste uguali in contemporanea
+# (es. cinque /report durante uno scrape) condividono un solo calcolo.
+_JOBS = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS, thread_name_prefix="tg-cmd")
+_SEEN_UPDATES = OrderedDict()   # update_id recenti, max 1000
+_UPD_LOCK = threading.Lock()
+_INFLIGHT = {}                  # chiave -> Future del calcolo in corso
+_INFLIGHT_LOCK = threading.Lock()
+
+def _is_duplicate(update_id):
+    if update_id is None: return False
+    with _UPD_LOCK:
+        if update_id in _SEEN_UPDATES: return True
+        _SEEN_UPDATES[update_id] = None
+        if len(_SEEN_UPDATES) > 1000:
+            _SEEN_UPDATES.popitem(last=False)
+    return False
+
+def _single_flight(key, fn):
+    """Esegue fn una volta sola per tutte le richieste con la stessa chiave arrivate mentre è in corso"""
+    with _INFLIGHT_LOCK:
+        fut = _INFLIGHT.get(key)
+        owner = fut is None
+        if owner:
+            fut = _INFLIGHT[key] = Future()
+    if not owner:
+        return fut.result()
+    try:
+        fut.set_result(fn())
+    except BaseException as e:
+        fut.set_exception(e)
+    finally:
+        with _INFLIGHT_LOCK:
+            _INFLIGHT.pop(key, None)
+    return fut.result()
+
+def _items():
+    return _single_flight("items", fetch_all_items)
+
+def _run_command(chat_id, text):
+    cmd = text.split()[0] if text.startswith("/") else "text"
+    before = metrics.sums() if metrics.DEBUG_TIMINGS else None
+    try:
+        with metrics.timed("command_seconds", command=cmd):
+            handle_command(chat_id, text)
+    except Exception as e:
+        metrics.inc("command_errors_total", command=cmd)
+        print("Command error:", text, e)
+        send_message(chat_id, "❌ Errore interno, riprova tra poco.")
+    if before is not None:
+        print(f"[timing] {cmd}:", metrics.breakdown(before))
+
 @app.post("/tg")
 async def tg_webhook(req: Request):
     update = await req.json()
+    if _is_duplicate(update.get("update_id")):
+        return {"ok": True}
     msg = update.get("message") or update.get("edited_message") or {}
     chat = msg.get("chat") or {}
     chat_id = chat.get("id")
@@ -85,7 +369,10 @@ async def tg_webhook(req: Request):
 
     if not chat_id or int(chat_id) != ALLOWED_CHAT_ID:
         return {"ok": True}
+    _JOBS.submit(_run_command, chat_id, text)
+    return {"ok": True}
 
+def handle_command(chat_id, text):
     if text.startswith("/start") or text.startswith("/help"):
         send_message(chat_id,
             "Comandi:\n"
@@ -99,22 +386,24 @@ async def tg_webhook(req: Request):
             "/config brand=peugeot,fiat maxprice=20000 maxkm=30000\n"
             "/segna <id_auto> – salva nei preferiti\n"
             "/preferiti – mostra i preferiti\n"
+            "/storico <id_auto> – andamento prezzo\n"
+            "/cerca brand=fiat tipo=ev maxprice=20000 maxkm=30000 ordina=prezzo pagina=1\n"
         )
-        return {"ok": True}
+        return
 
     # --- comandi base già esistenti ---
     if text.startswith("/report") or text == "report":
-        send_message(chat_id, build_report())
-        return {"ok": True}
+        send_message(chat_id, _single_flight("report", build_report))
+        return
     if text.startswith("/nuovo"):
         send_message(chat_id, build_section_nuovo())
-        return {"ok": True}
+        return
     if text.startswith("/km0"):
-        send_message(chat_id, build_section_km0())
-        return {"ok": True}
+        send_message(chat_id, _single_flight("km0", build_section_km0))
+        return
     if text.startswith("/usato"):
-        send_message(chat_id, build_section_usato())
-        return {"ok": True}
+        send_message(chat_id, _single_flight("usato", build_section_usato))
+        return
 
     # --- brand/dealer/type filters ---
     if text.startswith("/brand"):
@@ -123,37 +412,36 @@ async def tg_webhook(req: Request):
             send_message(chat_id, "Uso: /brand <marca> (es. /brand peugeot)")
         else:
             brand = parts[1]
-            items = filter_by_brand(fetch_all_items(), brand)
+            items = filter_by_brand(_items(), brand)
             send_message(chat_id, f"🔎 Filtra marca: {brand}\n\n" + format_cards(items[:10], with_images=False), parse_mode="Markdown")
-        return {"ok": True}
+        return
 
     # scorciatoie /peugeot /fiat /renault …
     for b in ["peugeot","fiat","renault","opel","kia","alfa","volkswagen","vw"]:
         if text.startswith("/"+b):
-            items = filter_by_brand(fetch_all_items(), b)
+            items = filter_by_brand(_items(), b)
             send_message(chat_id, f"🔎 {b.title()}\n\n" + format_cards(items[:10], with_images=False), parse_mode="Markdown")
-            return {"ok": True}
+            return
 
     if text.startswith("/dealer"):
         parts = text.split(maxsplit=1)
         if len(parts)<2:
             send_message(chat_id, "Uso: /dealer <nome> (es. /dealer aerre)")
         else:
-            items = filter_by_dealer(fetch_all_items(), parts[1])
+            items = filter_by_dealer(_items(), parts[1])
             send_message(chat_id, "🏪 Dealer\n\n" + format_cards(items[:10], with_images=False), parse_mode="Markdown")
-        return {"ok": True}
+        return
 
     if text.startswith("/elettriche") or text.startswith("/ibride") or text.startswith("/benzina"):
         t = "elettriche" if "/elettriche" in text else ("ibride" if "/ibride" in text else "benzina")
-        items = filter_by_type(fetch_all_items(), t)
+        items = filter_by_type(_items(), t)
         send_message(chat_id, f"⚡ Tipo: {t}\n\n" + format_cards(items[:10], with_images=False), parse_mode="Markdown")
-        return {"ok": True}
+        return
 
     # --- config utente ---
     if text.startswith("/config"):
         # es: /config brand=peugeot,fiat maxprice=20000 maxkm=30000
-        u = load_user(chat_id)
-        try:
+        def apply(u):
             body = text.replace("/config","").strip()
             for token in body.split():
                 if token.startswith("brand="):
@@ -163,11 +451,12 @@ async def tg_webhook(req: Request):
                     u["max_price"] = int(token.split("=",1)[1])
                 elif token.startswith("maxkm="):
                     u["max_km"] = int(token.split("=",1)[1])
-            save_user(chat_id, u)
+        try:
+            u = update_user(chat_id, apply)
             send_message(chat_id, f"✅ Config salvata: {u}")
         except Exception as e:
             send_message(chat_id, f"❌ Config non valida. Esempio: /config brand=peugeot,fiat maxprice=20000 maxkm=30000\nErrore: {e}")
-        return {"ok": True}
+        return
 
     if text.startswith("/preferiti"):
         u = load_user(chat_id)
@@ -176,11 +465,11 @@ async def tg_webhook(req: Request):
             send_message(chat_id, "⭐ Nessun preferito salvato. Usa /segna <id_auto> sulle liste.")
         else:
             # ricostruisci card dai risultati correnti
-            items = fetch_all_items()
+            items = _items()
             index = {i["id"]: i for i in items}
             selected = [index[i] for i in favs if i in index]
             send_message(chat_id, "⭐ Preferiti\n\n" + format_cards(selected, with_images=False), parse_mode="Markdown")
-        return {"ok": True}
+        return
 
     if text.startswith("/segna"):
         parts = text.split(maxsplit=1)
@@ -188,14 +477,40 @@ async def tg_webhook(req: Request):
             send_message(chat_id, "Uso: /segna <id_auto>")
         else:
             idwanted = parts[1].strip().strip("[]")
-            u = load_user(chat_id)
-            favs = set(u.get("favs", []))
-            favs.add(idwanted)
-            u["favs"] = list(favs)[:50]
-            save_user(chat_id, u)
+            def add_fav(u):
+                favs = [f for f in u.get("favs", []) if f != idwanted] + [idwanted]
+                u["favs"] = favs[-50:]
+            update_user(chat_id, add_fav)
             send_message(chat_id, f"✅ Aggiunto ai preferiti: {idwanted}")
-        return {"ok": True}
+        return
+
+    if text.startswith("/cerca"):
+        # es: /cerca brand=fiat tipo=ev maxprice=20000 maxkm=30000 ordina=prezzo pagina=2
+        keys = {"brand": "brand", "dealer": "dealer", "tipo": "tipo", "minprice": "min_price",
+                "maxprice": "max_price", "maxkm": "max_km", "ordina": "sort", "pagina": "page"}
+        q = {}
+        try:
+            for token in text.replace("/cerca","").split():
+                k, v = token.split("=", 1)
+                k = keys[k]
+                q[k] = int(v) if k in ("min_price", "max_price", "max_km", "page") else v
+        except (ValueError, KeyError):
+            send_message(chat_id, "Uso: /cerca brand=fiat tipo=ev maxprice=20000 maxkm=30000 ordina=prezzo|-prezzo|km pagina=1")
+            return
+        res, total = get_index().query(**q)
+        page = q.get("page", 1)
+        pages = max(1, -(-total // 10))
+        send_message(chat_id, f"🔎 {total} risultati – pagina {page}/{pages}\n\n" + format_cards(res, with_images=False), parse_mode="Markdown")
+        return
+
+    if text.startswith("/storico"):
+        parts = text.split(maxsplit=1)
+        if len(parts)<2:
+            send_message(chat_id, "Uso: /storico <id_auto>")
+        else:
+            send_message(chat_id, build_storico(parts[1].strip().strip("[]")))
+        return
 
     # fallback
     send_message(chat_id, "Non ho capito. Scrivi /help per l’elenco comandi.")
-    return {"ok": True}
+    return
@@ -0,0 +1,40 @@
+"""Aggiorna le fixture del benchmark scaricando le pagine vere di SOURCES: prima pagina più le
+successive via rel="next" (fino a MAX_PAGES). Il link alla pagina successiva viene riscritto verso
+il server locale del benchmark (/<fonte>/page/<n>/).
+
+    python bench/record.py                 # tutte le fonti
+    python bench/record.py tizzi_km0       # solo alcune"""
+import os, sys, tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, "bench", "fixtures")
+
+def record(rc, key):
+    url, n, saved = rc.SOURCES[key], 1, []
+    while url and n <= rc.MAX_PAGES:
+        status, html, _ = rc._fetch(url)
+        if not html:
+            print(f"{key}: pagina {n} non scaricata (status {status})", file=sys.stderr)
+            break
+        nxt = rc._next_link(html, url) if n < rc.MAX_PAGES else None
+        m = rc._NEXT_RE.search(html)
+        href = rc._HREF_RE.search(m.group(0)) if m else None
+        if nxt and href:
+            html = html.replace(href.group(1), f"/{key}/page/{n + 1}/")
+        name = key + (f".{n}" if n > 1 else "") + ".html"
+        with open(os.path.join(FIXTURES, name), "w", encoding="utf-8") as f:
+            f.write(html)
+        saved.append(name)
+        url, n = nxt, n + 1
+    return saved
+
+def main():
+    os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="incentivi-record-"))
+    sys.path.insert(0, ROOT)
+    import report_core as rc
+    keys = sys.argv[1:] or list(rc.SOURCES)
+    for k in keys:
+        print(k, record(rc, k))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""Benchmark offline: le fixture HTML dei dealer (bench/fixtures) sono servite da un server locale,
+Telegram è un'API finta locale (TG_API_BASE), i dati vanno in una cartella temporanea. Niente rete.
+
+    python bench/run.py                       # JSON su stdout
+    python bench/run.py --out base.json
+    python bench/run.py --compare base.json   # tabella delle differenze (mediane) su stderr
+    python bench/run.py --latency 50          # ms di latenza simulata per ogni richiesta ai dealer
+
+Misura: _parse_list per dealer, fetch_all_items (a freddo e con cache HTTP), build_report
+(a freddo e dalla cache), /tick completo e una raffica di comandi sul webhook /tg, tutto attraverso
+l'app FastAPI servita da uvicorn. Le fixture si aggiornano dai siti veri con bench/record.py."""
+import os, sys, json, time, shutil, socket, hashlib, argparse, tempfile, threading, statistics, platform, subprocess
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, "bench", "fixtures")
+CHAT_ID = 424242
+SECRET = "bench"
+COMMANDS = ["/report", "/km0", "/usato", "/brand fiat", "/elettriche", "/dealer tizzi",
+            "/cerca brand=peugeot maxprice=30000 ordina=prezzo", "/preferiti"]
+
+# ---------- server locali ----------
+class _Fixtures(BaseHTTPRequestHandler):
+    """/<fonte>/ -> <fonte>.html, /<fonte>/page/<n>/ -> <fonte>.<n>.html; ETag sul contenuto (304)"""
+    latency = 0.0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        parts = [p for p in self.path.split("?")[0].split("/") if p]
+        name = parts[0] + (f".{parts[2]}" if len(parts) == 3 and parts[1] == "page" else "") if parts else ""
+        path = os.path.join(FIXTURES, name + ".html")
+        if not name or not os.path.exists(path):
+            self.send_response(404); self.end_headers(); return
+        with open(path, "rb") as f:
+            body = f.read()
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()[:16]
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304); self.send_header("ETag", etag); self.end_headers(); return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *a):
+        pass
+
+class _Telegram(BaseHTTPRequestHandler):
+    """API Telegram finta: accetta tutto e conta le chiamate"""
+    calls = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.lock:
+            _Telegram.calls += 1
+        body = b'{"ok":true,"result":{}}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *a):
+        pass
+
+def _serve(handler):
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{srv.server_address[1]}"
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# ---------- misure ----------
+def _stats(times):
+    ms = sorted(t * 1000 for t in times)
+    return {"runs": len(ms), "min_ms": round(ms[0], 3), "median_ms": round(statistics.median(ms), 3),
+            "mean_ms": round(statistics.fmean(ms), 3), "p95_ms": round(ms[min(len(ms) - 1, int(len(ms) * 0.95))], 3),
+            "max_ms": round(ms[-1], 3)}
+
+def _bench(fn, repeat, setup=None):
+    times = []
+    for _ in range(repeat):
+        if setup: setup()
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return _stats(times)
+
+def _commands_done(metrics):
+    with metrics._LOCK:
+        return sum(h[-2] for (name, _), h in metrics._HISTS.items() if name == "command_seconds")
+
+def _git_rev():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+def run(args):
+    fixtures_url = _serve(_Fixtures)
+    tg_url = _serve(_Telegram)
+    _Fixtures.latency = args.latency / 1000.0
+    # configurazione prima dell'import: report_core/app leggono l'ambiente al caricamento
+    os.environ.update({
+        "DATA_DIR": args.data, "TG_API_BASE": tg_url,
+        "TG_BOT_TOKEN": "bench", "TG_CHAT_ID": str(CHAT_ID), "RUN_SECRET": SECRET, "SCHEDULER": "0",
+        "TG_GLOBAL_RATE": "100000", "TG_CHAT_RATE": "100000",   # si misura il codice, non il rate limit
+        "SNAPSHOT_TTL": "3600"})
+    sys.path.insert(0, ROOT)
+    import requests, uvicorn
+    import report_core as rc
+    import metrics
+    import app
+    for k in rc.SOURCES:
+        rc.SOURCES[k] = f"{fixtures_url}/{k}/"
+
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(app.app, host="127.0.0.1", port=port, log_level="warning", lifespan="off"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    base = f"http://127.0.0.1:{port}"
+    http = requests.Session()
+    results = {}
+
+    # _parse_list per dealer (HTML già in memoria)
+    for k in rc.ALL_SOURCES:
+        with open(os.path.join(FIXTURES, k + ".html"), encoding="utf-8") as f:
+            html = f.read()
+        extractor = rc.EXTRACTORS.get(k, rc.jsonld_extractor)
+        n = len(rc._parse_list(html, rc.DEALERS[k], rc.PARSERS.get(k), rc.SOURCES[k], extractor))
+        results[f"parse_list.{k}"] = dict(_bench(
+            lambda: rc._parse_list(html, rc.DEALERS[k], rc.PARSERS.get(k), rc.SOURCES[k], extractor), args.repeat),
+            items=n, bytes=len(html.encode("utf-8")))
+
+    # fetch_all_items: a freddo (niente snapshot né cache HTTP, crawl completo) e con cache (304)
+    def cold():
+        rc._SNAP.clear()
+        rc._HTTP_CACHE = {}
+    results["fetch_all_items.cold"] = _bench(lambda: rc.fetch_all_items(force=True, full=True), args.repeat, cold)
+    results["fetch_all_items.cold"]["items"] = len(rc.fetch_all_items())
+    results["fetch_all_items.cached"] = _bench(lambda: rc.fetch_all_items(force=True), args.repeat)
+
+    # build_report: rendering da zero e servito dalla cache
+    def no_render_cache():
+        rc._SECTIONS.clear()
+        rc._RENDER_CACHE.clear()
+    results["build_report.cold"] = _bench(rc.build_report, args.repeat, no_render_cache)
+    results["build_report.cached"] = _bench(rc.build_report, args.repeat)
+
+    # /tick completo via HTTP: il primo giro trova tutto nuovo (alert), i successivi nessuna variazione
+    def tick():
+        r = http.get(f"{base}/tick", params={"key": SECRET}, timeout=120)
+        r.raise_for_status()
+        app.flush_outbox(60)
+    rc._SNAP.clear()
+    results["tick.first"] = _bench(tick, 1)
+    results["tick.steady"] = _bench(tick, args.repeat)
+
+    # raffica di comandi sul webhook: ack di tutte le richieste e completamento (comandi + invii)
+    sent, done0 = _Telegram.calls, _commands_done(metrics)
+    updates = [{"update_id": 10_000_000 + i,
+                "message": {"chat": {"id": CHAT_ID}, "text": COMMANDS[i % len(COMMANDS)]}} for i in range(args.burst)]
+    acks = []
+    def post(u):
+        t0 = time.perf_counter()
+        http.post(f"{base}/tg", json=u, timeout=60).raise_for_status()
+        acks.append(time.perf_counter() - t0)
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(post, updates))
+    acked = time.perf_counter() - t0
+    while _commands_done(metrics) - done0 < args.burst:
+        time.sleep(0.005)
+    app.flush_outbox(60)
+    results["webhook_burst"] = {"commands": args.burst, "concurrency": args.concurrency,
+                                "ack_all_ms": round(acked * 1000, 3), "complete_ms": round((time.perf_counter() - t0) * 1000, 3),
+                                "ack": _stats(acks), "telegram_calls": _Telegram.calls - sent}
+    server.should_exit = True
+
+    return {"meta": {"ts": time.strftime("%Y-%m-%dT%H:%M:%S"), "git": _git_rev(), "python": platform.python_version(),
+                     "html_parser": rc.HTML_PARSER, "repeat": args.repeat, "latency_ms": args.latency},
+            "results": results}
+
+def compare(old, new):
+    """Righe "nome  prima  dopo  delta%" sulle mediane (o sui tempi complessivi della raffica)"""
+    def value(r):
+        return r.get("median_ms", r.get("complete_ms"))
+    lines = [f"{'benchmark':<34}{'prima ms':>12}{'dopo ms':>12}{'delta':>9}"]
+    for name, r in new["results"].items():
+        a, b = value(old["results"].get(name, {})), value(r)
+        delta = f"{(b - a) / a * 100:+.1f}%" if a else "n/d"
+        lines.append(f"{name:<34}{'-' if a is None else f'{a:.2f}':>12}{b:>12.2f}{delta:>9}")
+    return "\n".join(lines)
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--repeat", type=int, default=20, help="ripetizioni per misura")
+    ap.add_argument("--burst", type=int, default=50, help="comandi inviati al webhook")
+    ap.add_argument("--concurrency", type=int, default=10, help="richieste parallele nella raffica")
+    ap.add_argument("--latency", type=float, default=0, help="latenza simulata dei dealer (ms)")
+    ap.add_argument("--out", help="scrive il JSON anche su file")
+    ap.add_argument("--compare", help="JSON di un run precedente da confrontare")
+    args = ap.parse_args()
+    args.data = tempfile.mkdtemp(prefix="incentivi-bench-")
+    try:
+        out = run(args)
+    finally:
+        shutil.rmtree(args.data, ignore_errors=True)
+    text = json.dumps(out, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print(compare(json.load(f), out), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Contatori e tempi in memoria (per processo), esposti in formato Prometheus da /metrics.
+
+    inc("fetch_requests_total", source="tizzi_km0", status="200")
+    with timed("parse_seconds", dealer="Tizzi"): ...
+
+Con DEBUG_TIMINGS=1 ogni richiesta HTTP e ogni comando Telegram stampano il dettaglio dei tempi
+per fase (differenza delle somme prima/dopo: con richieste concorrenti i tempi si sommano)."""
+import os, time, threading
+from contextlib import contextmanager
+
+DEBUG_TIMINGS = os.getenv("DEBUG_TIMINGS", "0") == "1"
+PREFIX = "incentivi_"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_LOCK = threading.Lock()
+_COUNTERS = {}   # (nome, labels) -> valore
+_GAUGES = {}     # (nome, labels) -> valore
+_HISTS = {}      # (nome, labels) -> [conteggi per bucket..., count, sum]
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def inc(name, value=1, **labels):
+    k = _key(name, labels)
+    with _LOCK:
+        _COUNTERS[k] = _COUNTERS.get(k, 0) + value
+
+def gauge(name, value, **labels):
+    with _LOCK:
+        _GAUGES[_key(name, labels)] = value
+
+def observe(name, seconds, **labels):
+    k = _key(name, labels)
+    with _LOCK:
+        h = _HISTS.get(k)
+        if h is None:
+            h = _HISTS[k] = [0] * (len(BUCKETS) + 2)
+        for i, b in enumerate(BUCKETS):
+            if seconds <= b: h[i] += 1
+        h[-2] += 1
+        h[-1] += seconds
+
+@contextmanager
+def timed(name, **labels):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - t0, **labels)
+
+# ---------- dettaglio per richiesta (debug) ----------
+def sums():
+    """Somme dei tempi per serie: da passare a breakdown() a fine richiesta"""
+    with _LOCK:
+        return {k: h[-1] for k, h in _HISTS.items()}
+
+def breakdown(before):
+    """{"nome{labels}": secondi} spesi dopo lo snapshot `before`, dal più lento"""
+    out = {}
+    for k, total in sums().items():
+        d = total - before.get(k, 0.0)
+        if d > 0:
+            out[_series(*k)] = round(d, 4)
+    return dict(sorted(out.items(), key=lambda x: -x[1]))
+
+# ---------- formato Prometheus ----------
+def _series(name, labels, extra=()):
+    lab = ",".join(f'{k}="{_esc(v)}"' for k, v in tuple(labels) + tuple(extra))
+    return f"{PREFIX}{name}{{{lab}}}" if lab else PREFIX + name
+
+def _esc(v):
+    return v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def render():
+    """Testo per /metrics (text/plain; version=0.0.4)"""
+    with _LOCK:
+        counters, gauges = dict(_COUNTERS), dict(_GAUGES)
+        hists = {k: list(h) for k, h in _HISTS.items()}
+    lines, typed = [], set()
+    def typ(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+    for (name, labels), v in sorted(counters.items()):
+        typ(name, "counter")
+        lines.append(f"{_series(name, labels)} {v}")
+    for (name, labels), v in sorted(gauges.items()):
+        typ(name, "gauge")
+        lines.append(f"{_series(name, labels)} {v}")
+    for (name, labels), h in sorted(hists.items()):
+        typ(name, "histogram")
+        for b, c in zip(BUCKETS, h):
+            lines.append(f"{_series(name + '_bucket', labels, (('le', str(b)),))} {c}")
+        lines.append(f"{_series(name + '_bucket', labels, (('le', '+Inf'),))} {h[-2]}")
+        lines.append(f"{_series(name + '_count', labels)} {h[-2]}")
+        lines.append(f"{_series(name + '_sum', labels)} {round(h[-1], 6)}")
+    return "\n".join(lines) + "\n"
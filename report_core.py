@@ -1,15 +1,43 @@
 # report_core.py
-import re, math, json, os, hashlib, requests
+import re, math, json, os, hashlib, time, threading, sqlite3, requests
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeout
 from datetime import datetime, timedelta
-from bs4 import BeautifulSoup
+from urllib.parse import urljoin, urlsplit, urlunsplit, parse_qsl, urlencode
+from bs4 import BeautifulSoup, SoupStrainer
+from requests.adapters import HTTPAdapter
+import metrics
+
+try:
+    import lxml  # noqa: F401  parser veloce, opzionale
+    HTML_PARSER = os.getenv("HTML_PARSER", "lxml")
+except ImportError:
+    HTML_PARSER = os.getenv("HTML_PARSER", "html.parser")
 
 HDRS = {"User-Agent": "Mozilla/5.0 (AutoReport/2.0)"}
 TIMEOUT = 15
-DATA_DIR = "/app/data"
+FETCH_WORKERS   = int(os.getenv("FETCH_WORKERS", "6"))        # dealer scaricati in parallelo
+SOURCE_DEADLINE = float(os.getenv("SOURCE_DEADLINE", "12"))   # secondi max per singola fonte
+FETCH_DEADLINE  = float(os.getenv("FETCH_DEADLINE", "20"))    # secondi max per l'intero giro
+MAX_PAGES       = int(os.getenv("MAX_PAGES", "5"))            # pagine massime per dealer
+SEEN_TTL_DAYS   = float(os.getenv("SEEN_TTL_DAYS", "30"))     # un annuncio sparito da più giorni torna "nuovo"
+SEEN_CAPACITY   = int(os.getenv("SEEN_CAPACITY", "5000"))     # id ricordati al massimo (LRU)
+SNAPSHOT_TTL    = float(os.getenv("SNAPSHOT_TTL", "600"))     # età massima snapshot prima del refresh in background
+FULL_CRAWL_EVERY = float(os.getenv("FULL_CRAWL_EVERY", "21600"))  # crawl completo di ogni fonte almeno ogni N secondi
+FUNDS_WINDOW_DAYS  = float(os.getenv("FUNDS_WINDOW_DAYS", "7"))   # letture usate per stimare il ritmo di consumo
+FUNDS_HORIZON_DAYS = float(os.getenv("FUNDS_HORIZON_DAYS", "5"))  # alert se l'esaurimento previsto è entro N giorni
+DATA_DIR = os.getenv("DATA_DIR", "/app/data")
 os.makedirs(DATA_DIR, exist_ok=True)
 STATE_PATH = os.path.join(DATA_DIR, "state.json")     # fondi/nuove promo/occasioni (ultimo invio)
-USERS_PATH = os.path.join(DATA_DIR, "users.json")     # preferenze utenti e preferiti
-HIST_PATH  = os.path.join(DATA_DIR, "history.jsonl")  # storico prezzi (append)
+USERS_PATH = os.path.join(DATA_DIR, "users.json")     # vecchie preferenze utenti, importate nel db
+USERS_DB_PATH = os.path.join(DATA_DIR, "users.sqlite3")  # preferenze utenti e preferiti: una riga per chat
+HIST_PATH  = os.path.join(DATA_DIR, "history.jsonl")  # vecchio storico prezzi (append), importato nel db
+HIST_DB_PATH = os.path.join(DATA_DIR, "history.sqlite3")  # storico prezzi: una riga per variazione
+SEEN_DB_PATH = os.path.join(DATA_DIR, "seen.sqlite3")  # id già segnalati da detect_new_deals
+SNAP_PATH  = os.path.join(DATA_DIR, "last_tick.json")  # fonte -> {id: [prezzo, km]} all'ultimo giro, per il diff
+HTTP_CACHE_PATH = os.path.join(DATA_DIR, "http_cache.json")  # validatori ETag/Last-Modified + hash + items per URL
+FUNDS_DB_PATH = os.path.join(DATA_DIR, "funds.sqlite3")  # serie storica fondi Ecobonus: una riga per variazione
 
 SOURCES = {
     "aerre_motor_usato": "https://www.aerremotor.it/usato/",
@@ -20,43 +48,308 @@ SOURCES = {
     "ecobonus_fondi": "https://ecobonus.mimit.gov.it/",
 }
 
+# fonte -> etichetta dealer mostrata nei report
+DEALERS = {
+    "tizzi_km0": "Tizzi Automobili (Arezzo)",
+    "nuovauto_km0": "Nuovauto (Arezzo)",
+    "scotti_km0": "Scotti Ugo (Siena)",
+    "tosoni_km0": "Tosoni Auto (Siena)",
+    "aerre_motor_usato": "Aerre Motor (Arezzo)",
+}
+# parser BeautifulSoup per fonte (default HTML_PARSER); es. "html.parser" per siti con HTML troppo sporco per lxml
+PARSERS = {}
+# fonte -> estrattore dedicato: funzione (html, dealer, parser, base_url) -> items.
+# Si costruiscono con css_extractor(...) o jsonld_extractor; senza voce si prova il JSON-LD.
+# Se l'estrattore non trova niente si ripiega sull'euristica generica (_generic_items).
+#   es. EXTRACTORS["tizzi_km0"] = css_extractor("article.vehicle", title="h3", price=".price", km=".km")
+EXTRACTORS = {}
+MAX_ITEMS = 200   # tetto annunci per pagina
+# fonte -> template delle pagine successive alla prima ({n} = 2, 3, ...): pagine scaricate in parallelo
+# nel crawl completo. Senza template si segue il link rel="next" della pagina.
+#   es. PAGE_URLS["tizzi_km0"] = "https://www.tizziautomobili.it/km0/page/{n}/"
+PAGE_URLS = {}
+KM0_SOURCES   = ["tizzi_km0", "nuovauto_km0", "scotti_km0", "tosoni_km0"]
+USATO_SOURCES = ["aerre_motor_usato"]
+ALL_SOURCES   = KM0_SOURCES + USATO_SOURCES
+
 BRAND_LIST = ["peugeot","opel","kia","alfa","alfa romeo","volkswagen","vw","fiat","renault"]
 
-def _get(url):
+# ---------- fetch (sessione condivisa + parallelo) ----------
+_SESSION = None
+_POOL = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="fetch")
+_PAGE_POOL = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="fetch-page")  # pagine 2..n
+
+def _session():
+    """Sessione HTTP condivisa: keep-alive e pool di connessioni tra un tick e l'altro"""
+    global _SESSION
+    if _SESSION is None:
+        s = requests.Session()
+        s.headers.update(HDRS)
+        adapter = HTTPAdapter(pool_connections=len(SOURCES), pool_maxsize=FETCH_WORKERS)
+        s.mount("http://", adapter)
+        s.mount("https://", adapter)
+        _SESSION = s
+    return _SESSION
+
+def _source_label(url):
+    # fonte per le metriche: URL della lista (o sue sottopagine), altrimenti stesso host, altrimenti l'host
+    host = urlsplit(url).netloc
+    return (next((k for k, u in SOURCES.items() if url.startswith(u)), None)
+            or next((k for k, u in SOURCES.items() if urlsplit(u).netloc == host), host))
+
+def _fetch(url, headers=None, deadline=SOURCE_DEADLINE):
+    """GET con deadline totale (connessione + download). Ritorna (status, testo, headers):
+    status HTTP >= 400 con testo vuoto per le risposte di errore, status 0 = errore di trasporto.
+    Tempi, byte, status ed errori finiscono nelle metriche per fonte."""
+    src, code = _source_label(url), "error"
+    t0 = time.perf_counter()
     try:
-        r = requests.get(url, headers=HDRS, timeout=TIMEOUT)
-        r.raise_for_status()
-        return r.text
-    except Exception:
-        return ""
+        stop = time.monotonic() + deadline
+        with _session().get(url, headers=headers, timeout=min(TIMEOUT, deadline), stream=True) as r:
+            code = r.status_code
+            if r.status_code == 304:
+                return 304, "", r.headers
+            if r.status_code >= 400:
+                return r.status_code, "", r.headers
+            chunks = []
+            for chunk in r.iter_content(16384):
+                chunks.append(chunk)
+                if time.monotonic() > stop:
+                    raise TimeoutError("deadline superata durante il download")
+            body = b"".join(chunks)
+            metrics.inc("fetch_bytes_total", len(body), source=src)
+            return r.status_code, body.decode(r.encoding or "utf-8", errors="replace"), r.headers
+    except Exception as e:
+        metrics.inc("fetch_errors_total", source=src, error=type(e).__name__)
+        code = "error"
+        return 0, "", {}
+    finally:
+        metrics.observe("fetch_seconds", time.perf_counter() - t0, source=src)
+        metrics.inc("fetch_requests_total", source=src, status=code)
+
+# ---------- cache HTTP condizionale (ETag/Last-Modified + hash del body) ----------
+_HTTP_CACHE = None    # url -> {"etag", "last_modified", "hash", "parse_version", "items", "next"}
+_HTTP_CACHE_LOCK = threading.Lock()
+_HTTP_CACHE_DIRTY = False   # modifiche in memoria non ancora su disco
+
+def _http_cache_put(url, entry):
+    global _HTTP_CACHE_DIRTY
+    with _HTTP_CACHE_LOCK:
+        _http_cache()[url] = entry
+        _HTTP_CACHE_DIRTY = True
+
+def _flush_http_cache():
+    """Una scrittura per giro (non per pagina): JSON compatto, file temporaneo + os.replace"""
+    global _HTTP_CACHE_DIRTY
+    with _HTTP_CACHE_LOCK:
+        if not _HTTP_CACHE_DIRTY: return
+        text = json.dumps(_HTTP_CACHE, ensure_ascii=False, separators=(",", ":"))
+        _HTTP_CACHE_DIRTY = False
+    _write_atomic(HTTP_CACHE_PATH, text)
+
+def _http_cache():
+    global _HTTP_CACHE
+    if _HTTP_CACHE is None:
+        _HTTP_CACHE = _load_json(HTTP_CACHE_PATH, {})
+    return _HTTP_CACHE
+
+def _validators(entry):
+    h = {}
+    if entry.get("etag"): h["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"): h["If-Modified-Since"] = entry["last_modified"]
+    return h
+
+_NEXT_RE = re.compile(r'<(?:a|link)\b[^>]*\brel=["\']?next\b[^>]*>', re.I)
+_HREF_RE = re.compile(r'\bhref=["\']?([^"\' >]+)', re.I)
+
+def _next_link(html, base):
+    m = _NEXT_RE.search(html)
+    h = _HREF_RE.search(m.group(0)) if m else None
+    return urljoin(base, h.group(1).replace("&amp;", "&")) if h else None
+
+def _cached_page(url):
+    with _HTTP_CACHE_LOCK:
+        entry = _http_cache().get(url) or {}
+    if entry.get("parse_version") != PARSE_VERSION:
+        return [], None
+    return entry.get("items", []), entry.get("next")
+
+def _fetch_page(key, url, deadline=SOURCE_DEADLINE):
+    """(items, url pagina successiva): 304 o body identico all'ultimo giro -> items già parsati, senza BeautifulSoup.
+    Pagina inesistente (4xx) -> ([], None), cioè fine lista. Errore di rete/5xx/deadline -> items dell'ultimo
+    giro se ci sono, altrimenti ConnectionError: una lista troncata farebbe sembrare rimossi gli annunci."""
+    with _HTTP_CACHE_LOCK:
+        entry = dict(_http_cache().get(url) or {})
+    # items di un parser precedente: niente validatori, la pagina va riscaricata e riparsata
+    if entry.get("parse_version") != PARSE_VERSION:
+        entry = {}
+    status, html, hdrs = _fetch(url, headers=_validators(entry), deadline=deadline) if deadline > 0 else (0, "", {})
+    if status == 304 and "items" in entry:
+        return entry["items"], entry.get("next")
+    if not html:
+        if 400 <= status < 500:
+            return [], None
+        if "items" in entry:
+            return entry["items"], entry.get("next")
+        raise ConnectionError(f"pagina non disponibile ({status}): {url}")
+    digest = hashlib.sha1(html.encode("utf-8")).hexdigest()
+    if digest == entry.get("hash") and "items" in entry:
+        items, nxt = entry["items"], entry.get("next")
+    else:
+        items = _parse_list(html, DEALERS[key], PARSERS.get(key), url, EXTRACTORS.get(key, jsonld_extractor))
+        nxt = _next_link(html, url)
+    new = {"etag": hdrs.get("ETag"), "last_modified": hdrs.get("Last-Modified"), "hash": digest,
+           "parse_version": PARSE_VERSION, "items": items, "next": nxt}
+    if new != entry:
+        _http_cache_put(url, new)   # su disco a fine giro, vedi _flush_http_cache
+    return items, nxt
+
+_LAST_FULL = {}   # fonte -> monotonic dell'ultimo crawl completo
+
+def _fetch_source(key, full=False):
+    """Items di una fonte su più pagine (max MAX_PAGES).
+    Incrementale (default): si va avanti solo finché la pagina contiene annunci mai visti da
+    detect_new_deals; le pagine successive si riprendono dalla cache dell'ultimo crawl.
+    full=True: crawl completo, in parallelo se la fonte ha un template in PAGE_URLS. Scatta da
+    solo se l'ultimo è più vecchio di FULL_CRAWL_EVERY (o mai fatto da questo processo): senza,
+    venduti e variazioni nelle pagine dopo la prima non verrebbero mai visti.
+    SOURCE_DEADLINE vale per tutta la fonte: le pagine si dividono il tempo che resta."""
+    t0 = time.monotonic()
+    stop = t0 + SOURCE_DEADLINE
+    if not full and t0 - _LAST_FULL.get(key, float("-inf")) >= FULL_CRAWL_EVERY:
+        full = True
+    left = lambda: stop - time.monotonic()
+    items, nxt = _fetch_page(key, SOURCES[key], left())
+    if not items: return []
+    tpl = PAGE_URLS.get(key)
+    by_id = {i["id"]: i for i in items}
+    if full and tpl:
+        urls = [tpl.format(n=n) for n in range(2, MAX_PAGES + 1)]
+        for page, _ in _PAGE_POOL.map(lambda u: _fetch_page(key, u, left()), urls):
+            if not page or all(i["id"] in by_id for i in page): break  # fine lista (o pagina ripetuta)
+            by_id.update((i["id"], i) for i in page if i["id"] not in by_id)
+        _LAST_FULL[key] = t0
+        return list(by_id.values())
+    seen = None if full else SEEN
+    page, n, live = items, 1, True
+    while n < MAX_PAGES:
+        url = tpl.format(n=n + 1) if tpl else nxt
+        if not url: break
+        if live and seen is not None and all(i["id"] in seen for i in page):
+            live = False  # da qui in poi solo annunci già noti: niente più richieste
+        page, nxt = _fetch_page(key, url, left()) if live else _cached_page(url)
+        if not page or all(i["id"] in by_id for i in page): break
+        by_id.update((i["id"], i) for i in page if i["id"] not in by_id)
+        n += 1
+    if full: _LAST_FULL[key] = t0
+    return list(by_id.values())
+
+def fetch_sources(keys, deadline=FETCH_DEADLINE, full=False):
+    """Scarica e parsa le fonti in parallelo: {fonte: items}.
+    Le fonti che sforano la deadline complessiva o vanno in errore non compaiono (risultato parziale)."""
+    futs = {_POOL.submit(_fetch_source, k, full): k for k in keys}
+    out = {}
+    try:
+        for f in as_completed(futs, timeout=deadline):
+            try:
+                out[futs[f]] = f.result()
+            except Exception:
+                # fonte incompleta: resta lo snapshot precedente, niente diff su una lista parziale
+                metrics.inc("fetch_incomplete_total", source=futs[f])
+    except FuturesTimeout:
+        pass
+    _flush_http_cache()  # le fonti oltre la deadline finiscono nel flush del giro successivo
+    return out
+
+# ---------- snapshot condiviso (TTL + stale-while-revalidate) ----------
+_SNAP = {}            # fonte -> {"ts": monotonic, "items": [...]}
+_SNAP_LOCK = threading.Lock()
+_REFRESHING = set()   # fonti con refresh in background già in corso
+_SNAP_VERSION = 0     # cresce quando cambia il contenuto di almeno una fonte
+
+def _refresh(keys, full=False):
+    global _SNAP_VERSION
+    got = fetch_sources(keys, full=full)
+    now = time.monotonic()
+    with _SNAP_LOCK:
+        for k in keys:
+            items = got.get(k)
+            # fonte giù/vuota: teniamo l'ultimo snapshot buono se c'è
+            if items or k not in _SNAP:
+                if k not in _SNAP or _SNAP[k]["items"] != (items or []):
+                    _SNAP_VERSION += 1
+                _SNAP[k] = {"ts": now, "items": items or []}
+            else:
+                _SNAP[k]["ts"] = now
+            _REFRESHING.discard(k)
+
+def snapshot_version():
+    return _SNAP_VERSION
+
+def _refresh_async(keys):
+    with _SNAP_LOCK:
+        keys = [k for k in keys if k not in _REFRESHING]
+        _REFRESHING.update(keys)
+    if keys:
+        threading.Thread(target=_refresh, args=(keys,), daemon=True, name="snapshot-refresh").start()
+
+def get_snapshot(keys, force=False, full=False):
+    """{fonte: items} dallo snapshot in memoria.
+    force=True riscarica subito (full=True: tutte le pagine, vedi _fetch_source); fonti mai scaricate
+    vengono scaricate in linea; fonti più vecchie di SNAPSHOT_TTL vengono servite così come sono
+    e rinfrescate in background."""
+    with _SNAP_LOCK:
+        missing = list(keys) if (force or full) else [k for k in keys if k not in _SNAP]
+    if missing:
+        _refresh(missing, full=full)
+    now = time.monotonic()
+    with _SNAP_LOCK:
+        stale = [k for k in keys if now - _SNAP[k]["ts"] > SNAPSHOT_TTL]
+        out = {k: _SNAP[k]["items"] for k in keys}
+    if stale:
+        _refresh_async(stale)
+    return out
+
+def _merge(by_source, keys):
+    items = []
+    for k in keys:
+        items += by_source.get(k, [])
+    return items
 
 def _clean(s): 
     return re.sub(r"\s+"," ", s or "").strip()
 
-def _price(text):
-    m = re.search(r'(\d[\d\.\s]{1,12})\s*€', text)
-    if not m: return math.nan
-    raw = m.group(1).replace('.','').replace(' ','')
-    try: return float(raw)
-    except: return math.nan
+# pattern precompilati: il testo del nodo viene messo in minuscolo una volta sola
+_PRICE_RE = re.compile(r'(\d[\d\.\s]{1,12})\s*€')
+_KM_RE    = re.compile(r'(\d[\d\.\s]{1,7})\s*km')
+_RATE_RE  = re.compile(r'\s*(?:/\s*mese|al mese|mensil)')   # subito dopo il prezzo: è una rata
+_EV_RE    = re.compile(r'\b(?:500e|bev|electric|ev|e-tech|e-?208|mokka-?e|id\.\d)\b')
+_PHEV_RE  = re.compile(r'\b(?:phev|plug[-\s]?in|e[-\s]?hybrid|hybrid4|recharge)\b')
+_BRAND_RE = re.compile("|".join(re.escape(b) for b in BRAND_LIST))  # tutte le marche in un'unica scansione
+_BRAND_RANK = {b: i for i, b in enumerate(BRAND_LIST)}
+_CANDIDATES = SoupStrainer(["article","div","li"])
+PARSE_VERSION = "5"   # da incrementare quando cambia l'estrazione (invalida gli items in http_cache)
 
-def _km(text):
-    mk = re.search(r'(\d[\d\.\s]{1,7})\s*km', text, re.I)
-    if not mk: return None
-    return int(mk.group(1).replace('.','').replace(' ',''))
+def _num(raw):
+    return raw.replace('.','').replace(' ','')
 
-def _is_ev(text):
-    return bool(re.search(r'\b(500e|bev|electric|ev|e-tech|e-?208|mokka-?e|id\.\d)\b', text, re.I))
+def _prices(t):
+    """prezzi nel testo minuscolo, escluse le rate ("da 199 € al mese", "199 €/mese")"""
+    return [m for m in _PRICE_RE.finditer(t) if not _RATE_RE.match(t, m.end())]
 
-def _is_phev(text):
-    return bool(re.search(r'\b(phev|plug[-\s]?in|e[-\s]?hybrid|hybrid4|recharge)\b', text, re.I))
-
-def _brand(text):
+def _extract(text):
+    """(price, km, brand, is_ev, is_phev) di un nodo; price nan se assente, km/brand None"""
     t = text.lower()
-    for b in BRAND_LIST:
-        if b in t: 
-            return "volkswagen" if b=="vw" else b
-    return None
+    m = next(iter(_prices(t)), None)
+    try: price = float(_num(m.group(1))) if m else math.nan
+    except ValueError: price = math.nan
+    m = _KM_RE.search(t)
+    km = int(_num(m.group(1))) if m else None
+    found = _BRAND_RE.findall(t)
+    # più marche nel testo: vince l'ordine di BRAND_LIST
+    brand = min(found, key=_BRAND_RANK.__getitem__) if found else None
+    if brand == "vw": brand = "volkswagen"
+    return price, km, brand, _EV_RE.search(t) is not None, _PHEV_RE.search(t) is not None
 
 def _icons(price, km, is_ev, is_phev):
     out=[]
@@ -78,39 +371,222 @@ def _hash_id(*parts):
     h = hashlib.sha1(("||".join([str(p) for p in parts])).encode("utf-8")).hexdigest()[:10]
     return h
 
-def _parse_list(html, dealer):
+def _link_hint(tag, base):
+    a = tag.find("a", href=True)
+    if not a or a["href"].startswith(("#", "javascript:", "tel:", "mailto:")): return None
+    return urljoin(base, a["href"]) if base else a["href"]
+
+# nomi esatti: un prefisso come "ref" toglierebbe anche chiavi vere (reference=, refid=) e annunci
+# diversi finirebbero sullo stesso id; solo utm_* è una famiglia intera
+_TRACKING_PARAMS = {"fbclid", "gclid", "dclid", "msclkid", "mc_cid", "mc_eid", "ref", "_ga"}
+_TRACKING_PREFIXES = ("utm_",)
+
+def _canonical_url(url):
+    # senza frammento, parametri di tracking e slash finale: stesso annuncio -> stesso URL
+    p = urlsplit(url)
+    q = [(k, v) for k, v in parse_qsl(p.query)
+         if k.lower() not in _TRACKING_PARAMS and not k.lower().startswith(_TRACKING_PREFIXES)]
+    return urlunsplit((p.scheme.lower(), p.netloc.lower(), p.path.rstrip("/") or "/", urlencode(sorted(q)), ""))
+
+def _identity_text(text):
+    # testo normalizzato per l'identità: senza prezzi/km (che cambiano) né punteggiatura
+    t = _KM_RE.sub(" ", _PRICE_RE.sub(" ", text.lower()))
+    return " ".join(re.findall(r"[a-z0-9]+", t))[:80]
+
+def _listing_id(dealer, url=None, text="", km=None):
+    """Id stabile: dealer + URL canonico dell'annuncio, altrimenti dealer + titolo normalizzato + km.
+    Non dipende dal prezzo: un ribasso non cambia l'id."""
+    if url:
+        return _hash_id(dealer, _canonical_url(url))
+    return _hash_id(dealer, _identity_text(text), km)
+
+def _item(text, dealer, title=None, price=None, km=None, image=None, url=None):
+    """dict annuncio: i campi strutturati (se presenti) vincono su quelli estratti dal testo"""
+    p, k, br, ev, phev = _extract(text)
+    price = p if price is None else price
+    km = k if km is None else km
+    key_text = title or text
+    title = _clean(title or text[:80])
+    return {
+        # id da testo; _parse_list lo passa all'URL quando l'URL identifica un solo annuncio
+        "id": _listing_id(dealer, None, key_text, km),
+        "title": title,
+        "brand": br,
+        "price": price if not math.isnan(price) else None,
+        "km": km,
+        "dealer": dealer,
+        "is_ev": ev,
+        "is_phev": phev,
+        "image": image,
+        "url": url,
+    }
+
+def _signal(t):
+    # il testo (minuscolo) ha almeno un prezzo o un km: può essere (o contenere) un annuncio
+    return bool(_prices(t)) or _KM_RE.search(t) is not None
+
+_CANDIDATE_TAGS = {"article", "div", "li"}
+_OLD_PRICE_TAGS = ["s", "del", "strike"]
+
+def _child_candidates(node):
+    # candidati più vicini sotto `node`, attraversando eventuali tag intermedi (section, span, ...)
+    for ch in node.children:
+        if getattr(ch, "name", None) is None: continue
+        if ch.name in _CANDIDATE_TAGS: yield ch
+        else: yield from _child_candidates(ch)
+
+def _is_list(node):
+    """il nodo è una lista di annunci: almeno due figli con la stessa forma (tag + prima classe)
+    che portano ciascuno prezzo o km. Prezzo barrato, rata o specifiche dentro una card hanno
+    forme diverse (o nessun segnale), quindi la card resta un annuncio solo."""
+    shapes = defaultdict(int)
+    for ch in _child_candidates(node):
+        t = ch.get_text(" ", strip=True)
+        if len(t) < 15 or not _signal(t.lower()): continue
+        shape = (ch.name, (ch.get("class") or [""])[0])
+        shapes[shape] += 1
+        if shapes[shape] == 2: return True
+    return False
+
+def _generic_items(html, dealer, parser=None, base=None):
+    """Euristica generica: il nodo article/div/li più esterno con prezzo o km che non è una lista.
+    Le liste vengono aperte, dentro un annuncio già preso non si scende: così ogni auto compare
+    una volta sola anche se annidata in più wrapper."""
     out=[]
-    if not html: return out
-    soup = BeautifulSoup(html, "html.parser")
-    for c in soup.find_all(["article","div","li"], limit=30):
-        t = c.get_text(" ", strip=True)
-        if not t or len(t) < 15: 
+    soup = BeautifulSoup(html, parser or HTML_PARSER, parse_only=_CANDIDATES)
+    stack = list(_child_candidates(soup))[::-1]
+    while stack and len(out) < MAX_ITEMS:
+        node = stack.pop()
+        t = node.get_text(" ", strip=True)
+        if len(t) < 15 or not _signal(t.lower()): continue
+        if _is_list(node):
+            stack.extend(list(_child_candidates(node))[::-1])
             continue
-        price=_price(t)
-        km=_km(t)
-        br=_brand(t)
-        ev=_is_ev(t)
-        phev=_is_phev(t)
-        title = _clean(t[:80])
-        image = _img_hint(c)
-        # id univoco
-        uid=_hash_id(title, dealer, price)
-        out.append({
-            "id": uid,
-            "title": title,
-            "brand": br,
-            "price": price if not math.isnan(price) else None,
-            "km": km,
-            "dealer": dealer,
-            "is_ev": ev,
-            "is_phev": phev,
-            "image": image
-        })
+        old = node.find_all(_OLD_PRICE_TAGS)
+        if old:
+            # prezzo barrato: fuori dal testo, così il prezzo dell'annuncio è quello di vendita
+            for o in old: o.decompose()
+            t = node.get_text(" ", strip=True)
+        out.append(_item(t, dealer, image=_img_hint(node), url=_link_hint(node, base)))
     return out
 
+def css_extractor(card, title=None, price=None, km=None):
+    """Estrattore per selettori CSS: `card` seleziona un nodo per annuncio, gli altri (opzionali)
+    il sotto-nodo con titolo/prezzo/km; i campi mancanti si ricavano dal testo della card."""
+    def _field(node, sel):
+        if not sel: return None
+        el = node.select_one(sel)
+        return el.get_text(" ", strip=True) if el else None
+    def extract(html, dealer, parser=None, base=None):
+        out=[]
+        soup = BeautifulSoup(html, parser or HTML_PARSER)
+        for c in soup.select(card, limit=MAX_ITEMS):
+            t = c.get_text(" ", strip=True)
+            if not t: continue
+            pt, kt = _field(c, price), _field(c, km)
+            p = _extract(pt + " €")[0] if pt else None
+            k = _extract(kt + " km")[1] if kt else None
+            out.append(_item(t, dealer, title=_field(c, title), price=p, km=k,
+                             image=_img_hint(c), url=_link_hint(c, base)))
+        return out
+    return extract
+
+_LDJSON_RE = re.compile(r'<script[^>]+application/ld\+json[^>]*>(.*?)</script>', re.S | re.I)
+_LD_VEHICLES = {"Car", "Vehicle", "Product", "Motorcycle"}
+
+def _ld_nodes(obj):
+    # appiattisce @graph, ItemList e liste annidate
+    if isinstance(obj, list):
+        for o in obj: yield from _ld_nodes(o)
+    elif isinstance(obj, dict):
+        yield obj
+        for k in ("@graph", "itemListElement", "item"):
+            if k in obj: yield from _ld_nodes(obj[k])
+
+def _ld_first(v):
+    return v[0] if isinstance(v, list) and v else v
+
+def _ld_price(offer):
+    v = offer.get("price", offer.get("lowPrice"))
+    if isinstance(v, (int, float)): return float(v)
+    if isinstance(v, str) and v.strip():
+        try: return float(v.replace(",", ".")) if re.fullmatch(r"\d+([.,]\d{1,2})?", v.strip()) else float(_num(v.split(",")[0]))
+        except ValueError: return None
+    return None
+
+def _ld_km(v):
+    if isinstance(v, (int, float)): return int(v)
+    if isinstance(v, str) and re.search(r"\d", v):
+        try: return int(_num(v.split(",")[0]))
+        except ValueError: return None
+    return None
+
+def jsonld_extractor(html, dealer, parser=None, base=None):
+    """Annunci schema.org (Car/Vehicle/Product) dai blocchi <script type="application/ld+json">, senza BeautifulSoup"""
+    out=[]
+    for block in _LDJSON_RE.findall(html):
+        try: data = json.loads(block)
+        except ValueError: continue
+        for n in _ld_nodes(data):
+            types = n.get("@type")
+            types = set(types) if isinstance(types, list) else {types}
+            if not (types & _LD_VEHICLES) or not n.get("name"): continue
+            brand = _ld_first(n.get("brand"))
+            brand = brand.get("name") if isinstance(brand, dict) else brand
+            engine = _ld_first(n.get("vehicleEngine"))
+            fuel = engine.get("fuelType") if isinstance(engine, dict) else None
+            text = " ".join(str(x) for x in (brand, n["name"], fuel, n.get("fuelType"), n.get("description")) if x)
+            odo = n.get("mileageFromOdometer")
+            km = _ld_km(odo.get("value") if isinstance(odo, dict) else odo)
+            img = _ld_first(n.get("image"))
+            img = img.get("url") if isinstance(img, dict) else img
+            if isinstance(img, str) and img.startswith("//"): img = "https:" + img
+            offer = _ld_first(n.get("offers"))
+            offer = offer if isinstance(offer, dict) else {}
+            url = n.get("url") or offer.get("url")
+            out.append(_item(text, dealer, title=n["name"], price=_ld_price(offer), km=km,
+                             image=img, url=urljoin(base, url) if (base and url) else url))
+            if len(out) >= MAX_ITEMS: return out
+    return out
+
+def _parse_list(html, dealer, parser=None, base=None, extractor=None):
+    if not html: return []
+    with metrics.timed("parse_seconds", dealer=dealer):
+        out = _parse_items(html, dealer, parser, base, extractor)
+    metrics.inc("parse_items_total", len(out), dealer=dealer)
+    return out
+
+def _parse_items(html, dealer, parser, base, extractor):
+    items = []
+    if extractor:
+        try: items = extractor(html, dealer, parser, base)
+        except Exception: items = []
+    if not items:
+        items = _generic_items(html, dealer, parser, base)
+    # l'URL identifica l'annuncio solo se è suo: link condivisi (es. "contatti" in ogni card) non valgono
+    urls = {}
+    for it in items:
+        if it.get("url"): urls[it["url"]] = urls.get(it["url"], 0) + 1
+    for it in items:
+        if it.get("url") and urls[it["url"]] == 1:
+            it["id"] = _listing_id(dealer, it["url"])
+    # stessa auto ripetuta nella pagina (es. slider + lista): una sola volta
+    seen, out = set(), []
+    for it in items[:MAX_ITEMS]:
+        if it["id"] not in seen:
+            seen.add(it["id"]); out.append(it)
+    return out
+
+def _write_atomic(path, text):
+    # file temporaneo + os.replace: un crash a metà scrittura non lascia un file troncato
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with metrics.timed("store_write_seconds", store=os.path.basename(path)):
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
+
 def _save_json(path, obj):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(obj, f, ensure_ascii=False, indent=2)
+    _write_atomic(path, json.dumps(obj, ensure_ascii=False, indent=2))
 
 def _load_json(path, default):
     try:
@@ -119,12 +595,193 @@ def _load_json(path, default):
     except Exception:
         return default
 
+# ---------- storico prezzi (SQLite) ----------
+# Una riga per (annuncio, variazione di prezzo/km/titolo): first_ts = prima osservazione
+# di quei valori, last_ts = ultima. Osservazioni identiche aggiornano solo last_ts.
+_HIST_DB = None
+_HIST_LOCK = threading.RLock()
+_HIST_LAST = {}   # id -> (rowid, price, km, title) dell'ultima riga, per il confronto senza query
+_HIST_GEN = 0     # cresce a ogni variazione registrata (invalida la sezione ribassi in cache)
+
+def _hist_db():
+    global _HIST_DB
+    if _HIST_DB is None:
+        db = sqlite3.connect(HIST_DB_PATH, check_same_thread=False, timeout=30)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS history(
+                id TEXT NOT NULL, dealer TEXT, title TEXT, price REAL, km INTEGER,
+                first_ts TEXT NOT NULL, last_ts TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS ix_history_id ON history(id, first_ts);
+            CREATE INDEX IF NOT EXISTS ix_history_dealer ON history(dealer, first_ts);
+            CREATE INDEX IF NOT EXISTS ix_history_ts ON history(first_ts);
+            CREATE TABLE IF NOT EXISTS listing_stats(
+                id TEXT PRIMARY KEY, dealer TEXT, title TEXT,
+                first_seen TEXT, last_seen TEXT, last_price REAL, min_price REAL, max_price REAL,
+                drop_from REAL, drop_to REAL, drop_ts TEXT);
+            CREATE INDEX IF NOT EXISTS ix_stats_drop ON listing_stats(drop_ts);
+        """)
+        if (db.execute("SELECT 1 FROM history LIMIT 1").fetchone()
+                and not db.execute("SELECT 1 FROM listing_stats LIMIT 1").fetchone()):
+            _backfill_stats(db)
+        for rowid, id_, price, km, title in db.execute(
+                "SELECT rowid, id, price, km, title FROM history ORDER BY rowid"):
+            _HIST_LAST[id_] = (rowid, price, km, title)
+        _HIST_DB = db
+        if os.path.exists(HIST_PATH):
+            import_history_jsonl(HIST_PATH)
+    return _HIST_DB
+
+# aggregati per annuncio aggiornati a ogni osservazione (niente riletture dello storico):
+# prima/ultima vista, prezzo attuale/min/max e ultimo ribasso
+_STATS_UPSERT = """
+    INSERT INTO listing_stats(id, dealer, title, first_seen, last_seen, last_price, min_price, max_price)
+    VALUES (:id, :dealer, :title, :ts, :ts, :price, :price, :price)
+    ON CONFLICT(id) DO UPDATE SET
+        title=excluded.title, last_seen=excluded.last_seen,
+        drop_from=CASE WHEN excluded.last_price < listing_stats.last_price THEN listing_stats.last_price ELSE drop_from END,
+        drop_to=CASE WHEN excluded.last_price < listing_stats.last_price THEN excluded.last_price ELSE drop_to END,
+        drop_ts=CASE WHEN excluded.last_price < listing_stats.last_price THEN excluded.last_seen ELSE drop_ts END,
+        last_price=COALESCE(excluded.last_price, listing_stats.last_price),
+        min_price=MIN(COALESCE(listing_stats.min_price, excluded.min_price), COALESCE(excluded.min_price, listing_stats.min_price)),
+        max_price=MAX(COALESCE(listing_stats.max_price, excluded.max_price), COALESCE(excluded.max_price, listing_stats.max_price))
+"""
+
+def _record_history(db, items, ts):
+    # chiamare con _HIST_LOCK: un'unica transazione per tutto il batch
+    global _HIST_GEN
+    touch, changed = [], []
+    with metrics.timed("store_write_seconds", store="history"), db:
+        for it in items:
+            last = _HIST_LAST.get(it["id"])
+            if last and last[1:] == (it["price"], it["km"], it["title"]):
+                touch.append((ts, last[0], it["id"]))
+                continue
+            cur = db.execute(
+                "INSERT INTO history(id, dealer, title, price, km, first_ts, last_ts) VALUES (?,?,?,?,?,?,?)",
+                (it["id"], it["dealer"], it["title"], it["price"], it["km"], ts, ts))
+            _HIST_LAST[it["id"]] = (cur.lastrowid, it["price"], it["km"], it["title"])
+            changed.append({"id": it["id"], "dealer": it["dealer"], "title": it["title"], "price": it["price"], "ts": ts})
+        db.executemany("UPDATE history SET last_ts=? WHERE rowid=?", [t[:2] for t in touch])
+        db.executemany("UPDATE listing_stats SET last_seen=? WHERE id=?", [(t[0], t[2]) for t in touch])
+        db.executemany(_STATS_UPSERT, changed)
+    if changed:
+        _HIST_GEN += 1
+
+def _backfill_stats(db):
+    # una tantum: db creato prima degli aggregati
+    rows = db.execute("SELECT id, dealer, title, price, first_ts, last_ts FROM history ORDER BY rowid").fetchall()
+    with db:
+        for id_, dealer, title, price, first_ts, last_ts in rows:
+            rec = {"id": id_, "dealer": dealer, "title": title, "price": price}
+            db.execute(_STATS_UPSERT, dict(rec, ts=first_ts))
+            db.execute("UPDATE listing_stats SET last_seen=? WHERE id=?", (last_ts, id_))
+
 def _append_history(items):
     ts = datetime.utcnow().isoformat()
-    with open(HIST_PATH, "a", encoding="utf-8") as f:
-        for it in items:
-            rec = {"ts": ts, "id": it["id"], "title": it["title"], "dealer": it["dealer"], "price": it["price"], "km": it["km"]}
-            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    with _HIST_LOCK:
+        _record_history(_hist_db(), items, ts)
+
+def import_history_jsonl(path=HIST_PATH):
+    """Import una tantum del vecchio history.jsonl: le righe ripetute collassano sulle variazioni.
+    Il file viene prima rinominato in .importing (rename atomico: con più worker lo importa uno solo)
+    e a fine import in .imported per non reimportarlo."""
+    work = path + ".importing"
+    try:
+        os.replace(path, work)
+    except FileNotFoundError:
+        return  # già preso da un altro worker
+    batch, ts = [], None
+    db = _hist_db()
+    with _HIST_LOCK, open(work, "r", encoding="utf-8") as f:
+        for line in f:
+            try: rec = json.loads(line)
+            except ValueError: continue
+            if rec.get("ts") != ts and batch:
+                _record_history(db, batch, ts); batch = []
+            ts = rec.get("ts")
+            batch.append(rec)
+        if batch:
+            _record_history(db, batch, ts)
+    os.replace(work, path + ".imported")
+
+def listing_stats(listing_id):
+    """Aggregati di un annuncio (lookup per chiave primaria) o None"""
+    with _HIST_LOCK:
+        cur = _hist_db().execute("SELECT * FROM listing_stats WHERE id=?", (listing_id,))
+        row = cur.fetchone()
+    return dict(zip([c[0] for c in cur.description], row)) if row else None
+
+def recent_drops(days=7, limit=5):
+    """Ultimi ribassi di prezzo registrati negli ultimi `days` giorni, dal più recente"""
+    since = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    with _HIST_LOCK:
+        cur = _hist_db().execute(
+            "SELECT * FROM listing_stats WHERE drop_ts >= ? ORDER BY drop_ts DESC LIMIT ?", (since, limit))
+        rows = cur.fetchall()
+    cols = [c[0] for c in cur.description]
+    return [dict(zip(cols, r)) for r in rows]
+
+def price_history(listing_id):
+    """Variazioni registrate per un annuncio, dalla più vecchia"""
+    with _HIST_LOCK:
+        rows = _hist_db().execute(
+            "SELECT first_ts, last_ts, price, km, title, dealer FROM history WHERE id=? ORDER BY first_ts",
+            (listing_id,)).fetchall()
+    return [dict(zip(("first_ts", "last_ts", "price", "km", "title", "dealer"), r)) for r in rows]
+
+# ---------- rendering con cache ----------
+_RENDER_LOCK = threading.Lock()
+_RENDER_CACHE = OrderedDict()   # (tipo, contenuto annuncio) -> testo, LRU
+_RENDER_MAX = 4000
+_SECTIONS = {}                  # nome -> (chiave, testo)
+_MD_ESCAPE = str.maketrans({c: "\\" + c for c in "_*`["})
+
+def _md(s):
+    """Escape per parse_mode=Markdown (legacy), fuori dalle entità"""
+    return str(s).translate(_MD_ESCAPE)
+
+def _card_key(i):
+    return (i["id"], i["title"], i.get("price"), i.get("km"), i["dealer"], i.get("is_ev"), i.get("is_phev"))
+
+def _cached(key, render):
+    with _RENDER_LOCK:
+        text = _RENDER_CACHE.get(key)
+        if text is not None:
+            _RENDER_CACHE.move_to_end(key)
+            return text
+    text = render()
+    with _RENDER_LOCK:
+        _RENDER_CACHE[key] = text
+        if len(_RENDER_CACHE) > _RENDER_MAX:
+            _RENDER_CACHE.popitem(last=False)
+    return text
+
+def _cached_section(name, key, render):
+    hit = _SECTIONS.get(name)
+    if hit and hit[0] == key:
+        return hit[1]
+    text = render()
+    _SECTIONS[name] = (key, text)
+    return text
+
+def _fmt_km(v):
+    return "N/D" if v is None else f"{v:,}".replace(",",".")
+
+def _render_line(c):
+    icons = _icons(c.get('price'), c.get('km'), c.get('is_ev'), c.get('is_phev'))
+    return f"- [{c['id']}] {c['title']} – {_fmt_km(c.get('km'))} km {icons} – {_eur(c.get('price'))} – {c['dealer']}"
+
+def _render_card(i, with_images):
+    # titolo in grassetto: dentro un'entità non si può fare escape, si toglie solo l'asterisco
+    icons = _icons(i.get('price'), i.get('km'), i.get('is_ev'), i.get('is_phev'))
+    lines = [f"*[{i['id']}] {i['title'].replace('*', '')}*",
+             f"Km: {_fmt_km(i.get('km'))}",
+             f"Prezzo: {_eur(i.get('price'))}",
+             f"📍 {_md(i['dealer'])}"]
+    if with_images and i.get("image"): lines.append("🔗 Foto: " + _md(i["image"]))
+    if icons: lines.append(icons)
+    return "\n".join(lines)
 
 # ---------- sezioni principali ----------
 def build_section_nuovo():
@@ -132,66 +789,98 @@ def build_section_nuovo():
            "— In attesa di promo locali Ecobonus e pronta consegna EV/PHEV nei dealer di Arezzo/Siena"]
     return "\n".join(lines)
 
-def build_section_km0():
-    items=[]
-    items += _parse_list(_get(SOURCES["tizzi_km0"]),  "Tizzi Automobili (Arezzo)")
-    items += _parse_list(_get(SOURCES["nuovauto_km0"]),"Nuovauto (Arezzo)")
-    items += _parse_list(_get(SOURCES["scotti_km0"]), "Scotti Ugo (Siena)")
-    items += _parse_list(_get(SOURCES["tosoni_km0"]), "Tosoni Auto (Siena)")
-    items_sorted = sorted(items, key=lambda x: (x.get("km") or 999999))
-    _append_history(items_sorted)
-    lines=["# 2) 🚗 Km0"]
-    if not items_sorted:
-        lines.append("— Nessun Km0 rilevato ora (continua monitoraggio).")
+def _listing_section(name, keys, by_source, ver, header, empty, limit):
+    # riga per annuncio dalla cache; la sezione si ricalcola solo a snapshot cambiato (lo storico
+    # lo scrive snapshot_events, il rendering non ha effetti collaterali)
+    def render():
+        items_sorted = sorted(_merge(by_source, keys), key=lambda x: (x.get("km") or 999999))
+        lines=[header]
+        if not items_sorted:
+            lines.append(empty)
+        lines += [_cached(("line",) + _card_key(c), lambda c=c: _render_line(c)) for c in items_sorted[:limit]]
         return "\n".join(lines)
-    for c in items_sorted[:8]:
-        icons = _icons(c.get('price'), c.get('km'), c.get('is_ev'), c.get('is_phev'))
-        price = "N/D" if c.get("price") is None else f"{int(c['price']):,} €".replace(",",".")
-        km = "N/D" if c.get("km") is None else f"{c['km']:,}".replace(",",".")
-        lines.append(f"- [{c['id']}] {c['title']} – {km} km {icons} – {price} – {c['dealer']}")
-    return "\n".join(lines)
+    return _cached_section(name, (ver,), render)
+
+def build_section_km0(by_source=None, ver=None):
+    ver = snapshot_version() if ver is None else ver
+    by_source = by_source if by_source is not None else get_snapshot(KM0_SOURCES)
+    return _listing_section("km0", KM0_SOURCES, by_source, ver, "# 2) 🚗 Km0",
+                            "— Nessun Km0 rilevato ora (continua monitoraggio).", 8)
+
+def build_section_usato(by_source=None, ver=None):
+    ver = snapshot_version() if ver is None else ver
+    by_source = by_source if by_source is not None else get_snapshot(USATO_SOURCES)
+    return _listing_section("usato", USATO_SOURCES, by_source, ver,
+                            "# 3) ♻️ Usato incentivabile (ordine per km crescente; 🌟 <30k km, ⚡ EV/PHEV, 💶 <10k€)",
+                            "— Nessun usato rilevato ora (continua monitoraggio).", 10)
+
+def _eur(v):
+    return "N/D" if v is None else f"{int(v):,} €".replace(",",".")
 
-def build_section_usato():
-    items = _parse_list(_get(SOURCES["aerre_motor_usato"]), "Aerre Motor (Arezzo)")
-    items_sorted = sorted(items, key=lambda x: (x.get("km") or 999999))
-    _append_history(items_sorted)
-    lines=["# 3) ♻️ Usato incentivabile (ordine per km crescente; 🌟 <30k km, ⚡ EV/PHEV, 💶 <10k€)"]
-    if not items_sorted:
-        lines.append("— Nessun usato rilevato ora (continua monitoraggio).")
+def build_section_drops(days=7, limit=5):
+    def render():
+        lines=[f"# 4) 📉 Ribassi di prezzo (ultimi {days} giorni)"]
+        drops = recent_drops(days, limit)
+        if not drops:
+            lines.append("— Nessun ribasso registrato.")
+            return "\n".join(lines)
+        for d in drops:
+            lines.append(f"- [{d['id']}] {d['title']} – {_eur(d['drop_from'])} → {_eur(d['drop_to'])} "
+                         f"(-{_eur(d['drop_from'] - d['drop_to'])}) – {d['dealer']}")
         return "\n".join(lines)
-    for c in items_sorted[:10]:
-        icons = _icons(c.get('price'), c.get('km'), c.get('is_ev'), c.get('is_phev'))
-        price = "N/D" if c.get("price") is None else f"{int(c['price']):,} €".replace(",",".")
-        km = "N/D" if c.get("km") is None else f"{c['km']:,}".replace(",",".")
-        lines.append(f"- [{c['id']}] {c['title']} – {km} km {icons} – {price} – {c['dealer']}")
+    # la finestra scorre col giorno: chiave = variazioni registrate + data
+    return _cached_section(f"drops:{days}:{limit}", (_HIST_GEN, datetime.utcnow().date()), render)
+
+def build_storico(listing_id, max_rows=10):
+    """Testo per /storico <id>: aggregati + ultime variazioni"""
+    st = listing_stats(listing_id)
+    if not st:
+        return f"Nessuno storico per [{listing_id}]."
+    lines=[f"📈 Storico [{listing_id}] {st['title']}",
+           f"📍 {st['dealer']}",
+           f"Visto dal {st['first_seen'][:10]} al {st['last_seen'][:10]}",
+           f"Prezzo attuale: {_eur(st['last_price'])} (min {_eur(st['min_price'])}, max {_eur(st['max_price'])})"]
+    if st.get("drop_ts"):
+        lines.append(f"Ultimo ribasso: {_eur(st['drop_from'])} → {_eur(st['drop_to'])} il {st['drop_ts'][:10]}")
+    rows = price_history(listing_id)[-max_rows:]
+    if len(rows) > 1:
+        lines.append("")
+        for r in rows:
+            km = "N/D" if r["km"] is None else f"{r['km']:,}".replace(",",".")
+            lines.append(f"- {r['first_ts'][:10]}: {_eur(r['price'])} – {km} km")
     return "\n".join(lines)
 
 def build_report():
     now = datetime.now().strftime("%Y-%m-%d %H:%M")
     head = f"🚗⚡ Report incentivi Arezzo/Siena\n🕘 {now}\n\n"
+    ver = snapshot_version()   # letto prima dello snapshot: al più si ricalcola una volta di troppo
+    by_source = get_snapshot(KM0_SOURCES + USATO_SOURCES)
+    return head + _cached_section("report", (ver, _HIST_GEN, datetime.utcnow().date()),
+                                  lambda: _report_body(by_source, ver))
+
+def _report_body(by_source, ver):
     sections = [
         "🔥 Affari",
         "- Fiat 500e – Km0 – 2024 – 12.300 km 🌟⚡ – 17.900 € – Aerre Motor (Arezzo)",
         "",
         build_section_nuovo(),
         "",
-        build_section_km0(),
+        build_section_km0(by_source, ver),
         "",
-        build_section_usato(),
+        build_section_usato(by_source, ver),
+        "",
+        build_section_drops(),
         "",
         "Fondi Ecobonus (stima)\n— consulta ecobonus.mimit.gov.it (i dati live possono variare)"
     ]
-    return head + "\n".join(sections)
+    return "\n".join(sections)
 
 # ---------- filtri & query ----------
-def fetch_all_items():
-    items=[]
-    items += _parse_list(_get(SOURCES["tizzi_km0"]),  "Tizzi Automobili (Arezzo)")
-    items += _parse_list(_get(SOURCES["nuovauto_km0"]),"Nuovauto (Arezzo)")
-    items += _parse_list(_get(SOURCES["scotti_km0"]), "Scotti Ugo (Siena)")
-    items += _parse_list(_get(SOURCES["tosoni_km0"]), "Tosoni Auto (Siena)")
-    items += _parse_list(_get(SOURCES["aerre_motor_usato"]), "Aerre Motor (Arezzo)")
-    return items
+def fetch_all_items(force=False, full=False):
+    """Tutti gli annunci dallo snapshot condiviso; force=True (es. /tick) riscarica i dealer,
+    full=True rifà il crawl di tutte le pagine ignorando lo stop incrementale"""
+    keys = KM0_SOURCES + USATO_SOURCES
+    return _merge(get_snapshot(keys, force=force, full=full), keys)
 
 def filter_by_brand(items, brand):
     b = brand.lower()
@@ -208,6 +897,74 @@ def filter_by_dealer(items, dealer_kw):
     d = dealer_kw.lower()
     return [i for i in items if d in i["dealer"].lower()]
 
+# ---------- indice annunci per /cerca ----------
+def _brand_key(b):
+    b = b.lower().strip()
+    return "volkswagen" if b == "vw" else ("alfa" if b.startswith("alfa") else b)
+
+class ListingIndex:
+    """Indice costruito una volta per snapshot: insiemi di posizioni per marca, parole del dealer
+    e alimentazione, array ordinati per prezzo e km (range con bisect, ordinamento senza sort)."""
+
+    def __init__(self, items):
+        self.items = items
+        self.brand, self.dealer, self.tipo = defaultdict(set), defaultdict(set), defaultdict(set)
+        for pos, i in enumerate(items):
+            if i.get("brand"): self.brand[_brand_key(i["brand"])].add(pos)
+            for w in re.findall(r"\w+", i["dealer"].lower()): self.dealer[w].add(pos)
+            # come filter_by_type: un'auto sia EV sia PHEV (es. "E-Tech Plug-in") sta in entrambi
+            if i.get("is_ev"): self.tipo["ev"].add(pos)
+            if i.get("is_phev"): self.tipo["phev"].add(pos)
+            if not (i.get("is_ev") or i.get("is_phev")): self.tipo["termiche"].add(pos)
+        self.price = sorted((i["price"], pos) for pos, i in enumerate(items) if i.get("price") is not None)
+        self.km = sorted((i["km"], pos) for pos, i in enumerate(items) if i.get("km") is not None)
+
+    def _range(self, arr, lo, hi):
+        a = 0 if lo is None else bisect_left(arr, (lo, -1))
+        b = len(arr) if hi is None else bisect_right(arr, (hi, len(self.items)))
+        return {pos for _, pos in arr[a:b]}
+
+    def query(self, brand=None, dealer=None, tipo=None, min_price=None, max_price=None, max_km=None,
+              sort="prezzo", page=1, per_page=10):
+        """(risultati della pagina, totale); sort: prezzo | -prezzo | km"""
+        sets = []
+        if brand: sets.append(self.brand.get(_brand_key(brand), set()))
+        if dealer:
+            d = dealer.lower()
+            sets.append(set().union(*[p for w, p in self.dealer.items() if w.startswith(d)]))
+        if tipo:
+            t = {"elettriche": "ev", "elettrica": "ev", "ibride": "phev", "ibrida": "phev",
+                 "benzina": "termiche", "diesel": "termiche"}.get(tipo, tipo)
+            sets.append(self.tipo.get(t, set()))
+        if min_price is not None or max_price is not None:
+            sets.append(self._range(self.price, min_price, max_price))
+        if max_km is not None:
+            sets.append(self._range(self.km, None, max_km))
+        sets.sort(key=len)
+        hits = set.intersection(*sets) if sets else set(range(len(self.items)))
+        order = self.km if sort == "km" else self.price
+        seq = reversed(order) if sort == "-prezzo" else order
+        start = (max(page, 1) - 1) * per_page
+        ranked = []
+        for _, pos in seq:
+            if pos in hits:
+                ranked.append(pos)
+                if len(ranked) >= start + per_page: break
+        else:
+            have = set(ranked)
+            ranked += sorted(p for p in hits if p not in have)  # senza prezzo/km: in fondo
+        return [self.items[p] for p in ranked[start:start + per_page]], len(hits)
+
+_INDEX = (None, None)
+
+def get_index():
+    """Indice dello snapshot corrente, ricostruito solo se lo snapshot è cambiato"""
+    global _INDEX
+    ver = snapshot_version()   # prima dello snapshot: al più si ricostruisce una volta di troppo
+    if _INDEX[0] != ver or _INDEX[1] is None:
+        _INDEX = (ver, ListingIndex(fetch_all_items()))
+    return _INDEX[1]
+
 def filter_by_caps(items, max_price=None, max_km=None):
     out=[]
     for i in items:
@@ -218,44 +975,116 @@ def filter_by_caps(items, max_price=None, max_km=None):
     return out
 
 def format_cards(items, with_images=False):
-    lines=[]
-    for i in items:
-        price = "N/D" if i.get("price") is None else f"{int(i['price']):,} €".replace(",",".")
-        km = "N/D" if i.get("km") is None else f"{i['km']:,}".replace(",",".")
-        icons = _icons(i.get('price'), i.get('km'), i.get('is_ev'), i.get('is_phev'))
-        lines.append(
-            f"**[{i['id']}] {i['title']}**\n"
-            f"Km: {km}\n"
-            f"Prezzo: {price}\n"
-            f"📍 {i['dealer']}\n"
-            f"{'🔗 Foto: ' + i['image'] if (with_images and i.get('image')) else ''}"
-            f"{'' if icons=='' else f'\n{icons}'}"
-        )
+    """Schede per parse_mode=Markdown; ogni scheda è resa una volta per contenuto e poi presa dalla cache"""
+    lines=[_cached(("card", with_images and i.get("image")) + _card_key(i), lambda i=i: _render_card(i, with_images))
+           for i in items]
     return "\n\n".join(lines) if lines else "— Nessun risultato"
 
+def format_price_drops(events):
+    """Righe per gli eventi price_changed al ribasso"""
+    lines=[]
+    for e in events:
+        it = e["item"]
+        if e["type"] == "price_changed" and e["old"] and it.get("price") and it["price"] < e["old"]:
+            lines.append(f"- [{it['id']}] {it['title']} – {_eur(e['old'])} → {_eur(it['price'])} – {it['dealer']}")
+    return "\n".join(lines)
+
 # ---------- fondi & alert ----------
+_FUNDS_DB = None
+_FUNDS_LOCK = threading.Lock()
+_FUNDS_KINDS = ("ev", "phev", "low")
+_SCRIPT_RE = re.compile(r'<(script|style)\b.*?</\1\s*>', re.I | re.S)
+_TAG_RE    = re.compile(r'<[^>]+>')
+_PCT_RE    = re.compile(r'(\d{1,3})(?:\s|&nbsp;|&#160;)*(?:%|&#37;)')
+
+def _funds_db():
+    global _FUNDS_DB
+    if _FUNDS_DB is None:
+        db = sqlite3.connect(FUNDS_DB_PATH, check_same_thread=False, timeout=30)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS funds(
+                kind TEXT NOT NULL, pct INTEGER NOT NULL, first_ts REAL NOT NULL, last_ts REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS ix_funds_kind ON funds(kind, first_ts);
+        """)
+        _FUNDS_DB = db
+    return _FUNDS_DB
+
+def _parse_funds(html):
+    # niente BeautifulSoup: via script/style e tag, poi le prime tre percentuali del testo
+    txt = _TAG_RE.sub(" ", _SCRIPT_RE.sub(" ", html))
+    return {k: int(v) for k, v in zip(_FUNDS_KINDS, _PCT_RE.findall(txt))}
+
+def _record_funds(funds, ts):
+    # come lo storico prezzi: valore invariato -> si sposta solo last_ts dell'ultima riga
+    with _FUNDS_LOCK, metrics.timed("store_write_seconds", store="funds"):
+        db = _funds_db()
+        with db:
+            for k, pct in funds.items():
+                last = db.execute("SELECT rowid, pct FROM funds WHERE kind=? ORDER BY first_ts DESC LIMIT 1",
+                                  (k,)).fetchone()
+                if last and last[1] == pct:
+                    db.execute("UPDATE funds SET last_ts=? WHERE rowid=?", (ts, last[0]))
+                else:
+                    db.execute("INSERT INTO funds(kind, pct, first_ts, last_ts) VALUES (?,?,?,?)", (k, pct, ts, ts))
+
 def get_funds_estimate():
-    html=_get(SOURCES["ecobonus_fondi"])
-    if not html: return {}
-    txt = BeautifulSoup(html, "html.parser").get_text(" ", strip=True)
-    m = re.findall(r'(\d{1,3})\s*%', txt)
-    out={}
-    if len(m)>=1: out["ev"]=int(m[0])
-    if len(m)>=2: out["phev"]=int(m[1])
-    if len(m)>=3: out["low"]=int(m[2])
-    return out
+    """Percentuali fondi {ev, phev, low}: richiesta condizionale, niente parsing se la pagina non è
+    cambiata (304 o stesso hash); ogni lettura va nella serie storica."""
+    url = SOURCES["ecobonus_fondi"]
+    with _HTTP_CACHE_LOCK:
+        entry = dict(_http_cache().get(url) or {})
+    status, html, hdrs = _fetch(url, headers=_validators(entry))
+    if status == 304 and "funds" in entry:
+        funds = entry["funds"]
+    elif not html:
+        return {}
+    else:
+        digest = hashlib.sha1(html.encode("utf-8")).hexdigest()
+        funds = entry["funds"] if digest == entry.get("hash") and "funds" in entry else _parse_funds(html)
+        new = {"etag": hdrs.get("ETag"), "last_modified": hdrs.get("Last-Modified"), "hash": digest, "funds": funds}
+        if new != entry:
+            _http_cache_put(url, new)
+            _flush_http_cache()
+    if funds:
+        _record_funds(funds, time.time())
+    return dict(funds)
 
-def should_alert_low_funds(th=15):
+def funds_forecast(kind, window_days=FUNDS_WINDOW_DAYS):
+    """{"pct", "per_day", "days_left"} dalla retta dei minimi quadrati sulle letture della finestra;
+    days_left None se i fondi non stanno calando. None senza letture."""
+    since = time.time() - window_days * 86400
+    with _FUNDS_LOCK:
+        rows = _funds_db().execute(
+            "SELECT pct, first_ts, last_ts FROM funds WHERE kind=? AND last_ts >= ? ORDER BY first_ts",
+            (kind, since)).fetchall()
+    if not rows:
+        return None
+    pts = [(max(first, since), pct) for pct, first, _ in rows] + [(rows[-1][2], rows[-1][0])]
+    n = len(pts)
+    mt = sum(t for t, _ in pts) / n
+    mp = sum(p for _, p in pts) / n
+    var = sum((t - mt) ** 2 for t, _ in pts)
+    per_day = 0.0 if var == 0 else -sum((t - mt) * (p - mp) for t, p in pts) / var * 86400
+    pct = rows[-1][0]
+    days_left = pct / per_day if per_day > 0 else None
+    return {"pct": pct, "per_day": round(per_day, 2), "days_left": None if days_left is None else round(days_left, 1)}
+
+def should_alert_low_funds(th=15, horizon=FUNDS_HORIZON_DAYS):
+    """Alert (max uno ogni 12 ore) se EV/PHEV sono sotto soglia o se ne è previsto l'esaurimento entro horizon giorni"""
     st = _load_json(STATE_PATH, {"last_funds_alert_ts": None})
     funds = get_funds_estimate()
     now = datetime.utcnow()
-    need = False
-    below = {}
+    below, forecast = {}, {}
     for k in ("ev","phev"):
         v = funds.get(k)
-        if isinstance(v,int) and v < th:
-            below[k]=v; need=True
-    if need:
+        if not isinstance(v,int): continue
+        fc = funds_forecast(k)
+        if fc and fc["days_left"] is not None:
+            forecast[k] = fc["days_left"]
+        if v < th or forecast.get(k, horizon + 1) <= horizon:
+            below[k]=v
+    if below:
         last = st.get("last_funds_alert_ts")
         if last:
             try:
@@ -265,21 +1094,159 @@ def should_alert_low_funds(th=15):
             except: pass
         st["last_funds_alert_ts"]=now.isoformat()
         _save_json(STATE_PATH, st)
-        return {"below": below, "funds": funds}
+        return {"below": below, "funds": funds, "forecast": forecast}
     return None
 
+# ---------- id già visti (TTL + LRU) ----------
+class SeenSet:
+    """Insieme di id con scadenza (ttl secondi dall'ultima volta che sono stati toccati) e capienza
+    massima con eviction LRU. In memoria è un OrderedDict dal meno al più recente; su disco una
+    riga SQLite per id, aggiornata solo per gli id toccati o rimossi."""
+
+    def __init__(self, path, ttl, capacity):
+        self.path, self.ttl, self.capacity = path, ttl, capacity
+        self._lock = threading.RLock()
+        self._db = None
+        self._mem = OrderedDict()   # id -> ts ultimo tocco
+
+    def _conn(self):
+        if self._db is None:
+            db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS seen(id TEXT PRIMARY KEY, ts REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS ix_seen_ts ON seen(ts)")
+            self._mem = OrderedDict(db.execute("SELECT id, ts FROM seen ORDER BY ts"))
+            self._db = db
+            self._import_state_json()
+            self._evict()
+        return self._db
+
+    def _import_state_json(self):
+        # una tantum: vecchia lista seen_ids in state.json
+        st = _load_json(STATE_PATH, {})
+        if "seen_ids" in st:
+            self.touch(st.pop("seen_ids") or [])
+            _save_json(STATE_PATH, st)
+
+    def __contains__(self, id_):
+        with self._lock:
+            self._conn()
+            ts = self._mem.get(id_)
+            return ts is not None and ts >= time.time() - self.ttl
+
+    def __len__(self):
+        with self._lock:
+            self._conn()
+            return len(self._mem)
+
+    def touch(self, ids):
+        """Segna gli id come visti adesso (li porta in fondo all'ordine LRU)"""
+        now = time.time()
+        with self._lock:
+            db = self._conn()
+            rows = []
+            for id_ in ids:
+                self._mem[id_] = now
+                self._mem.move_to_end(id_)
+                rows.append((id_, now))
+            if rows:
+                with metrics.timed("store_write_seconds", store="seen"), db:
+                    db.executemany("INSERT INTO seen(id, ts) VALUES (?,?) ON CONFLICT(id) DO UPDATE SET ts=excluded.ts", rows)
+                self._evict()
+
+    def refresh(self, ids, every=86400):
+        """Rinfresca gli id ancora presenti, ma al più una volta ogni `every` secondi per id:
+        il TTL e l'ordine LRU seguono l'ultima volta che l'annuncio era online, con una scrittura
+        al giorno per id invece che a ogni giro. Gli id mai visti (o scaduti) restano fuori: li
+        aggiunge detect_new_deals, che altrimenti non li segnalerebbe come nuovi"""
+        now = time.time()
+        with self._lock:
+            self._conn()
+            stale = [i for i in ids if now - self.ttl <= self._mem.get(i, 0) < now - every]
+        self.touch(stale)
+
+    def _evict(self):
+        # scaduti e, oltre la capienza, i meno recenti: sono tutti in testa all'OrderedDict
+        limit = time.time() - self.ttl
+        gone = []
+        while self._mem:
+            id_, ts = next(iter(self._mem.items()))
+            if ts >= limit and len(self._mem) <= self.capacity: break
+            self._mem.popitem(last=False)
+            gone.append((id_,))
+        if gone:
+            with self._db:
+                self._db.executemany("DELETE FROM seen WHERE id=?", gone)
+
+SEEN = SeenSet(SEEN_DB_PATH, SEEN_TTL_DAYS * 86400, SEEN_CAPACITY)
+
 def detect_new_deals(items):
-    """Allerte nuove promo: confronta con ultimo snapshot in state"""
-    st = _load_json(STATE_PATH, {"seen_ids": []})
-    seen = set(st.get("seen_ids", []))
-    fresh = [i for i in items if i["id"] not in seen]
-    if fresh:
-        # aggiorna seen con max 300 id
-        new_seen = list(seen) + [i["id"] for i in fresh]
-        st["seen_ids"] = new_seen[-300:]
-        _save_json(STATE_PATH, st)
+    """Allerte nuove promo: id mai visti (o scaduti) in SEEN; costo proporzionale agli items passati"""
+    fresh, ids = [], {}
+    for i in items:
+        if i["id"] not in SEEN and i["id"] not in ids:
+            fresh.append(i)
+        ids[i["id"]] = None
+    SEEN.touch(ids)
     return fresh
 
+def mark_seen(ids):
+    """Rinfresca gli id (es. annunci appena spariti): il TTL parte dall'ultima volta che li abbiamo visti"""
+    SEEN.touch(ids)
+
+def refresh_seen(by_source):
+    """Annunci ancora online: restano in SEEN (niente scadenza né eviction finché sono listati)"""
+    SEEN.refresh([i["id"] for items in by_source.values() for i in items])
+
+# ---------- eventi (diff tra snapshot consecutivi) ----------
+def diff_items(old, items):
+    """Eventi tra lo snapshot precedente (id -> [prezzo, km]) e gli items attuali:
+    {"type": added|removed|price_changed|km_changed, "id", "item", "old"}"""
+    events, cur = [], {}
+    for it in items:
+        cur[it["id"]] = it
+        prev = old.get(it["id"])
+        if prev is None:
+            events.append({"type": "added", "id": it["id"], "item": it, "old": None})
+            continue
+        if prev[0] != it.get("price"):
+            events.append({"type": "price_changed", "id": it["id"], "item": it, "old": prev[0]})
+        if prev[1] != it.get("km"):
+            events.append({"type": "km_changed", "id": it["id"], "item": it, "old": prev[1]})
+    for id_, prev in old.items():
+        if id_ not in cur:
+            events.append({"type": "removed", "id": id_, "item": None, "old": prev})
+    return events
+
+_TICK_LOCK = threading.Lock()
+
+def snapshot_events(by_source):
+    """Diff per fonte rispetto all'ultimo giro (persistito in SNAP_PATH come {fonte: {id: [prezzo, km]}}):
+    aggiorna lo stato delle sole fonti passate e registra nello storico gli annunci online (righe nuove
+    solo per quelli nuovi o cambiati, per gli altri solo last_ts/last_seen).
+    Fonti andate in errore non risultano "removed": get_snapshot per una fonte giù mantiene
+    gli ultimi items buoni."""
+    with _TICK_LOCK:
+        state = _load_json(SNAP_PATH, {})
+        if any(not isinstance(v, dict) for v in state.values()):
+            state = {}  # vecchio formato piatto {id: [prezzo, km]}
+        events, dirty, online = [], False, []
+        for key, items in by_source.items():
+            old = state.get(key)
+            if old and not items:
+                continue  # fonte vuota dopo un giro con annunci: quasi sempre un errore, niente "removed" di massa
+            online += items
+            ev = diff_items(old or {}, items)
+            if old is None or ev:
+                state[key] = {i["id"]: [i.get("price"), i.get("km")] for i in items}
+                dirty = True
+            events += ev
+        if dirty:
+            _write_atomic(SNAP_PATH, json.dumps(state, ensure_ascii=False))
+    if online:
+        _append_history(online)  # una transazione: inserisce le variazioni, tocca gli invariati
+    return events
+
 def detect_flash_deals(items, km_cap=15000, price_cap=18000):
     hits=[]
     for i in items:
@@ -288,11 +1255,138 @@ def detect_flash_deals(items, km_cap=15000, price_cap=18000):
     return hits
 
 # ---------- preferenze & preferiti ----------
+# Una riga JSON per chat in SQLite (WAL, sicuro tra più worker uvicorn), letture dalla cache in
+# memoria. PRAGMA data_version cambia quando un altro processo fa commit: allora la cache si svuota.
+_USERS_DB = None
+_USERS_LOCK = threading.RLock()
+_USERS_CACHE = {}
+_USERS_VER = None
+_USERS_GEN = 0    # cresce a ogni update_user di questo processo
+
+def _default_user():
+    return {"brands": [], "max_price": None, "max_km": None, "favs": []}
+
+def _users_db():
+    global _USERS_DB
+    if _USERS_DB is None:
+        db = sqlite3.connect(USERS_DB_PATH, check_same_thread=False, timeout=30, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS users(chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated REAL)")
+        _USERS_DB = db
+        if os.path.exists(USERS_PATH):
+            _import_users_json(db)
+    return _USERS_DB
+
+def _import_users_json(db):
+    # una tantum: vecchio users.json. Con più worker lo importa chi prende per primo il lock in
+    # scrittura; gli altri, dopo il lock, non trovano più il file
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        if os.path.exists(USERS_PATH):
+            rows = [(int(k), json.dumps(v, ensure_ascii=False), time.time()) for k, v in _load_json(USERS_PATH, {}).items()]
+            db.executemany("INSERT OR IGNORE INTO users(chat_id, data, updated) VALUES (?,?,?)", rows)
+            os.replace(USERS_PATH, USERS_PATH + ".imported")
+        db.execute("COMMIT")
+    except FileNotFoundError:
+        db.execute("COMMIT")  # rinominato nel frattempo da un processo senza lock: righe già IGNORE
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+
+def _users_sync(db):
+    global _USERS_VER
+    ver = db.execute("PRAGMA data_version").fetchone()[0]
+    if ver != _USERS_VER:
+        _USERS_CACHE.clear()
+        _USERS_VER = ver
+
+def _read_user(db, chat_id):
+    row = db.execute("SELECT data FROM users WHERE chat_id=?", (chat_id,)).fetchone()
+    return json.loads(row[0]) if row else _default_user()
+
 def load_user(chat_id: int):
-    data = _load_json(USERS_PATH, {})
-    return data.get(str(chat_id), {"brands": [], "max_price": None, "max_km": None, "favs": []})
+    with _USERS_LOCK:
+        db = _users_db()
+        _users_sync(db)
+        u = _USERS_CACHE.get(int(chat_id))
+        if u is None:
+            u = _USERS_CACHE[int(chat_id)] = _read_user(db, int(chat_id))
+        return json.loads(json.dumps(u))  # copia: chi la modifica non tocca la cache
+
+def update_user(chat_id: int, fn):
+    """Read-modify-write atomico di un utente: fn(user) modifica il dict (o ne ritorna uno nuovo).
+    Se fn solleva eccezione non si salva niente. Ritorna l'utente salvato."""
+    with _USERS_LOCK, metrics.timed("store_write_seconds", store="users"):
+        db = _users_db()
+        db.execute("BEGIN IMMEDIATE")  # lock in scrittura anche verso gli altri processi
+        try:
+            u = _read_user(db, int(chat_id))
+            u = fn(u) or u
+            db.execute("INSERT INTO users(chat_id, data, updated) VALUES (?,?,?) "
+                       "ON CONFLICT(chat_id) DO UPDATE SET data=excluded.data, updated=excluded.updated",
+                       (int(chat_id), json.dumps(u, ensure_ascii=False), time.time()))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        _USERS_CACHE[int(chat_id)] = u
+        global _USERS_GEN
+        _USERS_GEN += 1
+        return json.loads(json.dumps(u))
 
 def save_user(chat_id: int, user):
-    data = _load_json(USERS_PATH, {})
-    data[str(chat_id)] = user
-    _save_json(USERS_PATH, data)
+    update_user(chat_id, lambda _: user)
+
+def all_users():
+    """{chat_id: preferenze} di tutte le chat"""
+    with _USERS_LOCK:
+        rows = _users_db().execute("SELECT chat_id, data FROM users").fetchall()
+    return {cid: json.loads(d) for cid, d in rows}
+
+# ---------- abbonamenti: preferenze /config -> notifiche personali ----------
+_INF = float("inf")
+
+class SubscriptionIndex:
+    """Regole di tutti gli utenti compilate per marca ("*" = qualsiasi marca). In ogni gruppo le
+    regole sono ordinate per prezzo massimo decrescente: per un annuncio si scorre solo finché
+    il tetto di prezzo regge, quindi il costo è ~O(annunci + match) e non utenti × annunci."""
+
+    def __init__(self, users):
+        groups = defaultdict(list)
+        for chat_id, u in users.items():
+            brands = [_brand_key(b) for b in u.get("brands") or []]
+            if not brands and u.get("max_price") is None and u.get("max_km") is None:
+                continue  # nessuna regola impostata: nessun abbonamento
+            rule = (_INF if u.get("max_price") is None else u["max_price"],
+                    _INF if u.get("max_km") is None else u["max_km"], int(chat_id))
+            for b in brands or ["*"]:
+                groups[b].append(rule)
+        self.groups = {b: sorted(r, key=lambda x: -x[0]) for b, r in groups.items()}
+
+    def match(self, items):
+        """{chat_id: [items]} in un solo passaggio sugli annunci"""
+        out = defaultdict(list)
+        for it in items:
+            price = it.get("price")
+            km = it.get("km")
+            chats = set()
+            for b in {_brand_key(it["brand"]) if it.get("brand") else None, "*"}:
+                for max_price, max_km, chat_id in self.groups.get(b, ()):
+                    if max_price != _INF and (price is None or price > max_price): break
+                    if max_km != _INF and (km is None or km > max_km): continue
+                    chats.add(chat_id)
+            for c in chats:
+                out[c].append(it)
+        return dict(out)
+
+_SUBS = (None, None)
+
+def match_subscriptions(items):
+    """Annunci nuovi/cambiati -> {chat_id: [items]}; l'indice si ricompila solo se le preferenze cambiano"""
+    global _SUBS
+    with _USERS_LOCK:
+        _users_sync(_users_db())
+        key = (_USERS_VER, _USERS_GEN)
+    if _SUBS[0] != key:
+        _SUBS = (key, SubscriptionIndex(all_users()))
+    return _SUBS[1].match(items)
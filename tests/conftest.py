@@ -0,0 +1,5 @@
+import os, sys, tempfile
+
+# report_core legge DATA_DIR all'import: i test non toccano /app/data
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="incentivi-test-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
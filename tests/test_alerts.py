@@ -0,0 +1,23 @@
+import app
+import report_core as rc
+
+def _car(n, price=15000.0):
+    return {"id": f"alert{n}", "title": f"Fiat Panda {n}", "url": f"https://example.it/auto/{n}", "brand": "fiat",
+            "price": price, "km": 10, "dealer": "Tizzi Automobili (Arezzo)", "is_ev": False, "is_phev": False}
+
+def _run(monkeypatch, items):
+    sent = []
+    monkeypatch.setattr(app, "get_snapshot", lambda keys, force=False, full=False: {"tizzi_km0": items})
+    monkeypatch.setattr(app, "send_message", lambda chat_id, text, parse_mode=None: sent.append(text))
+    monkeypatch.setattr(app, "send_photo", lambda *a, **k: None)
+    events = app.process_sources(["tizzi_km0"])
+    return events, [m for m in sent if m.startswith("🆕")]
+
+def test_new_listing_sends_new_promo(monkeypatch):
+    _run(monkeypatch, [_car(1), _car(2)])
+    events, promo = _run(monkeypatch, [_car(1), _car(2), _car(3)])
+    assert [e["id"] for e in events if e["type"] == "added"] == ["alert3"]
+    assert len(promo) == 1 and "Fiat Panda 3" in promo[0] and "Fiat Panda 1" not in promo[0]
+    # la nuova ora è in SEEN: al giro dopo niente alert ripetuti
+    assert "alert3" in rc.SEEN
+    assert _run(monkeypatch, [_car(1), _car(2), _car(3)])[1] == []
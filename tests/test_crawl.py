@@ -0,0 +1,27 @@
+import report_core as rc
+
+def _pages(monkeypatch, key):
+    # tre pagine collegate da rel="next"; ogni fetch viene contato
+    pages = {f"p{n}": ([{"id": f"{key}{n}{j}"} for j in range(3)], f"p{n + 1}" if n < 3 else None) for n in (1, 2, 3)}
+    fetched = []
+    def fetch_page(k, url, deadline=rc.SOURCE_DEADLINE):
+        fetched.append(url)
+        return pages[url]
+    monkeypatch.setitem(rc.SOURCES, key, "p1")
+    monkeypatch.setattr(rc, "_fetch_page", fetch_page)
+    monkeypatch.setattr(rc, "_cached_page", lambda url: pages[url])
+    return pages, fetched
+
+def test_incremental_crawl_refetches_later_pages_periodically(monkeypatch):
+    key = "crawl_test"
+    pages, fetched = _pages(monkeypatch, key)
+    rc.SEEN.touch(i["id"] for items, _ in pages.values() for i in items)
+    # primo giro del processo: crawl completo anche se la prima pagina è tutta già vista
+    assert len(rc._fetch_source(key)) == 9 and fetched == ["p1", "p2", "p3"]
+    # subito dopo: incrementale, le pagine successive dalla cache
+    fetched.clear()
+    assert len(rc._fetch_source(key)) == 9 and fetched == ["p1"]
+    # passato FULL_CRAWL_EVERY: di nuovo tutte le pagine
+    rc._LAST_FULL[key] -= rc.FULL_CRAWL_EVERY
+    fetched.clear()
+    assert len(rc._fetch_source(key)) == 9 and fetched == ["p1", "p2", "p3"]
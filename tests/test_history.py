@@ -0,0 +1,20 @@
+import report_core as rc
+
+def _car(n, price=15000.0):
+    return {"id": f"hist{n}", "title": f"Kia Picanto {n}", "brand": "kia", "price": price, "km": 5,
+            "dealer": "Scotti Ugo (Siena)", "is_ev": False, "is_phev": False}
+
+def test_rendering_does_not_write_history():
+    gen = rc._HIST_GEN
+    rc.build_section_km0({"scotti_km0": [_car(1)]}, ver=-1)
+    assert rc.listing_stats("hist1") is None and rc._HIST_GEN == gen
+
+def test_snapshot_events_touches_unchanged_listings():
+    rc.snapshot_events({"scotti_km0": [_car(2), _car(3)]})
+    first = rc.listing_stats("hist2")["last_seen"]
+    gen = rc._HIST_GEN
+    events = rc.snapshot_events({"scotti_km0": [_car(2), _car(3, price=14000.0)]})
+    assert [e["type"] for e in events] == ["price_changed"]
+    assert rc.listing_stats("hist2")["last_seen"] > first         # invariato: solo last_seen
+    assert len(rc.price_history("hist2")) == 1 and len(rc.price_history("hist3")) == 2
+    assert rc._HIST_GEN == gen + 1
@@ -0,0 +1,68 @@
+import random
+import report_core as rc
+
+BRANDS = ["fiat", "peugeot", "kia", "opel", "volkswagen", "renault", None]
+DEALERS = ["Tizzi Automobili (Arezzo)", "Nuovauto (Arezzo)", "Scotti Ugo (Siena)", "Tosoni Auto (Siena)"]
+
+def _items(n=300, seed=1):
+    r = random.Random(seed)
+    return [{"id": f"id{i}", "title": f"auto {i}", "brand": r.choice(BRANDS),
+             "price": r.choice([None, float(r.randint(5000, 40000))]), "km": r.choice([None, r.randint(0, 90000)]),
+             "dealer": r.choice(DEALERS), "is_ev": r.random() < 0.3, "is_phev": r.random() < 0.3}
+            for i in range(n)]
+
+def _by_price(items):
+    # a parità di prezzo (e senza prezzo, in fondo) vale l'ordine originale, come nell'indice
+    return sorted(items, key=lambda i: (i["price"] is None, i["price"] or 0, int(i["id"][2:])))
+
+def test_query_matches_linear_filters():
+    items = _items()
+    ix = rc.ListingIndex(items)
+    for tipo in ("elettriche", "ibride", "benzina"):
+        for max_price, max_km in ((None, None), (20000, None), (None, 30000), (25000, 50000)):
+            want = rc.filter_by_caps(rc.filter_by_type(items, tipo), max_price, max_km)
+            got, total = ix.query(tipo=tipo, max_price=max_price, max_km=max_km, per_page=len(items))
+            assert total == len(want)
+            assert [i["id"] for i in got] == [i["id"] for i in _by_price(want)]
+
+def test_query_brand_dealer_and_paging():
+    items = _items()
+    ix = rc.ListingIndex(items)
+    want = _by_price([i for i in items if i["brand"] in ("volkswagen",) and "siena" in i["dealer"].lower()])
+    got, total = ix.query(brand="vw", dealer="siena", per_page=len(items))
+    assert total == len(want) and [i["id"] for i in got] == [i["id"] for i in want]
+    page2, _ = ix.query(brand="vw", dealer="siena", page=2, per_page=3)
+    assert [i["id"] for i in page2] == [i["id"] for i in want[3:6]]
+
+def test_ev_and_phev_listing_is_in_both_types():
+    item = dict(_items(1)[0], is_ev=True, is_phev=True)
+    ix = rc.ListingIndex([item])
+    assert ix.query(tipo="ibride")[1] == len(rc.filter_by_type([item], "ibride")) == 1
+    assert ix.query(tipo="elettriche")[1] == 1
+    assert ix.query(tipo="benzina")[1] == 0
+
+def test_diff_items():
+    old = {"a": [10000.0, 100], "b": [20000.0, 200], "c": [30000.0, 300]}
+    items = [{"id": "a", "price": 10000.0, "km": 100}, {"id": "b", "price": 19000.0, "km": 250},
+             {"id": "d", "price": 5000.0, "km": None}]
+    ev = {(e["type"], e["id"]): e for e in rc.diff_items(old, items)}
+    assert set(ev) == {("price_changed", "b"), ("km_changed", "b"), ("added", "d"), ("removed", "c")}
+    assert ev[("price_changed", "b")]["old"] == 20000.0
+    assert ev[("removed", "c")]["item"] is None
+    assert rc.diff_items({i["id"]: [i["price"], i["km"]] for i in items}, items) == []
+
+def test_subscriptions_match_linear():
+    r = random.Random(2)
+    users = {c: {"brands": r.sample(["fiat", "peugeot", "kia", "vw"], r.randint(0, 2)),
+                 "max_price": r.choice([None, 10000, 20000, 30000]), "max_km": r.choice([None, 20000, 50000])}
+             for c in range(200)}
+    items = _items(100, seed=3)
+    got = rc.SubscriptionIndex(users).match(items)
+    want = {}
+    for it in items:
+        for c, u in users.items():
+            if not u["brands"] and u["max_price"] is None and u["max_km"] is None: continue
+            if u["brands"] and not (it["brand"] and rc._brand_key(it["brand"]) in {rc._brand_key(b) for b in u["brands"]}): continue
+            if rc.filter_by_caps([it], u["max_price"], u["max_km"]):
+                want.setdefault(c, []).append(it)
+    assert {c: [i["id"] for i in v] for c, v in got.items()} == {c: [i["id"] for i in v] for c, v in want.items()}
@@ -0,0 +1,17 @@
+import report_core as rc
+
+def test_canonical_url_drops_only_tracking_params():
+    c = rc._canonical_url
+    assert c("https://Dealer.it/auto/123/?utm_source=fb&utm_medium=x&fbclid=1&ref=home#foto") == "https://dealer.it/auto/123"
+    assert c("https://dealer.it/auto?gclid=1&id=7&mc_cid=2&mc_eid=3") == "https://dealer.it/auto?id=7"
+    # chiavi vere che iniziano come un parametro di tracking restano
+    for k in ("reference", "refid", "ref_auto", "mc_model"):
+        assert c(f"https://dealer.it/auto?{k}=1") == f"https://dealer.it/auto?{k}=1"
+    assert c("https://dealer.it/auto?b=2&a=1") == c("https://dealer.it/auto?a=1&b=2")
+
+def test_listings_with_reference_param_stay_distinct():
+    cards = "".join(f'<li class="car"><a href="/auto?reference={n}">Fiat Panda 1.0 Hybrid versione {n}</a>'
+                    f'<span>€ {12000 + n * 500}</span></li>' for n in (1, 2, 3))
+    items = rc._parse_list(f"<html><body><ul>{cards}</ul></body></html>", "Tizzi Automobili (Arezzo)",
+                           base="https://dealer.it/")
+    assert len(items) == 3 and len({i["id"] for i in items}) == 3